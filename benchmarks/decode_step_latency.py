@@ -0,0 +1,120 @@
+"""
+Per-step decoder latency as the decoded sequence grows.
+
+Runs the decoder of a randomly initialised Whisper with the preallocated
+self-attention cache used by `Inference` and, for reference, with a cache that
+grows by concatenation on every step. With the preallocated cache the latency
+at token 200 should match the latency at token 5.
+
+    python -m benchmarks.decode_step_latency --model tiny --batch-size 12
+"""
+
+import argparse
+import time
+
+import mlx.core as mx
+
+from lightning_whisper_mlx.decoding import Inference
+from lightning_whisper_mlx.whisper import ModelDimensions, Whisper
+
+DIMS = {
+    "tiny": (384, 6, 4),
+    "base": (512, 8, 6),
+    "small": (768, 12, 12),
+    "medium": (1024, 16, 24),
+    "large": (1280, 20, 32),
+}
+
+
+class ConcatenateKVCache:
+    """The former cache: grows by concatenation, copying every step."""
+
+    def __init__(self):
+        self.offset = 0
+        self.keys = None
+        self.values = None
+
+    def update_and_fetch(self, keys, values):
+        if self.keys is not None:
+            keys = mx.concatenate([self.keys, keys], axis=1)
+            values = mx.concatenate([self.values, values], axis=1)
+        self.keys, self.values = keys, values
+        self.offset = keys.shape[1]
+        return keys, values
+
+
+def build_model(name: str) -> Whisper:
+    n_state, n_head, n_layer = DIMS[name]
+    dims = ModelDimensions(
+        n_mels=80,
+        n_audio_ctx=1500,
+        n_audio_state=n_state,
+        n_audio_head=n_head,
+        n_audio_layer=n_layer,
+        n_vocab=51865,
+        n_text_ctx=448,
+        n_text_state=n_state,
+        n_text_head=n_head,
+        n_text_layer=n_layer,
+    )
+    model = Whisper(dims, mx.float16)
+    model.set_dtype(mx.float16)
+    mx.eval(model.parameters())
+    return model
+
+
+def step_latencies(inference, audio_features, n_prompt, n_steps):
+    n_batch = audio_features.shape[0]
+    tokens = mx.random.randint(0, 50257, (n_batch, n_prompt))
+    latencies = []
+    for _ in range(n_steps):
+        tic = time.perf_counter()
+        logits = inference.logits(tokens, audio_features)
+        next_tokens = logits[:, -1].argmax(axis=-1)
+        mx.eval(next_tokens)
+        latencies.append(time.perf_counter() - tic)
+        tokens = mx.concatenate([tokens, next_tokens[:, None]], axis=-1)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default="tiny", choices=list(DIMS))
+    parser.add_argument("--batch-size", type=int, default=12)
+    parser.add_argument("--prompt-len", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=220)
+    args = parser.parse_args()
+
+    mx.random.seed(0)
+    model = build_model(args.model)
+    audio_features = mx.random.normal(
+        (args.batch_size, model.dims.n_audio_ctx, model.dims.n_audio_state)
+    ).astype(mx.float16)
+
+    results = {}
+    for name in ("preallocated", "concatenate"):
+        inference = Inference(model, args.prompt_len)
+        # warm up once, then measure on a fresh cache
+        for n_steps in (8, args.steps):
+            inference.reset()
+            if name == "concatenate":
+                inference.kv_cache = [
+                    (ConcatenateKVCache(), None) for _ in model.decoder.blocks
+                ]
+            results[name] = step_latencies(
+                inference, audio_features, args.prompt_len, n_steps
+            )
+
+    print(f"model={args.model} batch_size={args.batch_size}")
+    print(f"{'token':>8} {'preallocated (ms)':>20} {'concatenate (ms)':>20}")
+    for start in range(5, args.steps, 25):
+        window = slice(start, min(start + 5, args.steps))
+        row = [
+            sum(results[name][window]) / len(results[name][window]) * 1e3
+            for name in ("preallocated", "concatenate")
+        ]
+        print(f"{start:>8} {row[0]:>20.2f} {row[1]:>20.2f}")
+
+
+if __name__ == "__main__":
+    main()
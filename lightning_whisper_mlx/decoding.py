@@ -1,13 +1,13 @@
 # Copyright © 2023 Apple Inc.
 
 import zlib
-from dataclasses import dataclass, field, replace
-from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+from dataclasses import astuple, dataclass, field, replace
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import mlx.core as mx
 import mlx.nn as nn
 import numpy as np
-from mlx.utils import tree_map
+from mlx.utils import tree_flatten, tree_map
 
 from .audio import CHUNK_LENGTH
 from .tokenizer import Tokenizer, get_tokenizer
@@ -90,6 +90,8 @@ class DecodingOptions:
     # sampling-related options
     temperature: float = 0.0
     sample_len: Optional[int] = None  # maximum number of tokens to sample
+    # and, for windows of a known duration, at most this many per second of audio
+    max_tokens_per_second: Optional[float] = None
     best_of: Optional[int] = None  # number of independent sample trajectories, if t > 0
     beam_size: Optional[int] = None  # number of beams in beam search, if t == 0
     patience: Optional[float] = None  # patience in beam search (arxiv:2204.05424)
@@ -112,8 +114,23 @@ class DecodingOptions:
     without_timestamps: bool = False  # use <|notimestamps|> to sample text tokens only
     max_initial_timestamp: Optional[float] = 1.0
 
+    # stop a sampled row as soon as its last `loop_tokens` text tokens repeat
+    # the ones a few tokens earlier, i.e. it loops over the same phrase
+    loop_tokens: Optional[int] = None
+
+    # speculative decoding: number of tokens proposed per step, by the draft
+    # model or, without one, by looking up the last `prompt_lookup` tokens (or
+    # fewer) in the prompt and the text decoded so far
+    draft_tokens: int = 4
+    prompt_lookup: Optional[int] = None
+
     # implementation details
     fp16: bool = True  # use fp16 for most of the calculation
+    # store the self- and cross-attention keys and values quantized to 4 or 8
+    # bits, in groups of `kv_group_size` channels, instead of in fp16
+    kv_bits: Optional[int] = None
+    kv_group_size: int = 64
+    compile_step: bool = False  # run the later steps as one compiled function
 
 
 @dataclass(frozen=True)
@@ -127,34 +144,585 @@ class DecodingResult:
     no_speech_prob: float = np.nan
     temperature: float = np.nan
     compression_ratio: float = np.nan
+    looped: bool = False  # stopped early by `loop_tokens`
+
+
+@dataclass(frozen=True)
+class Prefill:
+    """
+    The decoder state of a batch of audio after all its initial tokens but the
+    last one, which the first decoding step feeds. It depends on the audio and
+    the initial tokens only, so the fallback temperatures, the best-of-n samples
+    and the beams of an audio all start from it instead of running the prompt
+    through the decoder again.
+    """
+
+    audio_features: mx.array
+    tokens: mx.array  # the initial tokens, with the detected language tokens
+    padding: np.ndarray  # the number of padding columns on the left of each row
+    languages: List[str]
+    language_probs: Optional[List[Dict[str, float]]]
+    no_speech_probs: List[float]  # NaN for the rows whose last token is SOT
+    kv_cache: List[Optional[Tuple[mx.array, mx.array]]]  # per layer, or None
+    cross_kv: List[Optional[Tuple[mx.array, mx.array]]]  # per layer, see cross_kv()
+
+    def rows(self, indices: List[int]) -> "Prefill":
+        """The prefill of the given rows, without the padding columns they share"""
+        trim = int(self.padding[indices].min())
+        index = mx.array(indices)
+
+        def take(kv, start):
+            if kv is None:
+                return None
+            return tree_map(lambda x: x[index, start:], kv)
+
+        return Prefill(
+            audio_features=self.audio_features[index],
+            tokens=self.tokens[index, trim:],
+            padding=self.padding[indices] - trim,
+            languages=[self.languages[i] for i in indices],
+            language_probs=(
+                None
+                if self.language_probs is None
+                else [self.language_probs[i] for i in indices]
+            ),
+            no_speech_probs=[self.no_speech_probs[i] for i in indices],
+            kv_cache=[take(kv, trim) for kv in self.kv_cache],
+            cross_kv=[take(kv, 0) for kv in self.cross_kv],
+        )
+
+
+def quantize_kv(x: mx.array, bits: Optional[int], group_size: int = 64):
+    """
+    Quantize keys or values of shape (batch_size, n_columns, n_state) group-wise
+    along the channels, as the (packed, scales, biases) arrays of `mx.quantize`
+    that the attention reads directly; unchanged if `bits` is None
+    """
+    if bits is None:
+        return x
+    return tuple(mx.quantize(x, group_size=group_size, bits=bits))
+
+
+def kv_arrays(x) -> tuple:
+    """The arrays that hold keys or values, three if they are quantized"""
+    return x if isinstance(x, tuple) else (x,)
+
+
+class KVCache:
+    """
+    Self-attention key/value cache of one decoder layer, preallocated in blocks
+    of `step` columns up to the text context length. Each forward pass writes
+    its keys and values in place at the current offset and attention reads back
+    the filled prefix only, so a decode step costs the same at the last token as
+    at the first one. With `bits`, they are stored as `quantize_kv` does.
+    """
+
+    step = 64
+
+    def __init__(self, n_ctx: int, bits: Optional[int] = None, group_size: int = 64):
+        self.n_ctx = n_ctx
+        self.bits = bits
+        self.group_size = group_size
+        self.offset = 0
+        self.keys = None
+        self.values = None
+
+    def reserve(self, size: int):
+        """Make room for at least `size` columns"""
+        n_batch, capacity = kv_arrays(self.keys)[0].shape[:2]
+        if size <= capacity:
+            return
+        n_new = min(-(-size // self.step) * self.step, self.n_ctx) - capacity
+
+        def grow(x):
+            new = mx.zeros((n_batch, n_new, *x.shape[2:]), x.dtype)
+            return mx.concatenate([x, new], axis=1)
+
+        self.keys, self.values = tree_map(grow, (self.keys, self.values))
+
+    def update_and_fetch(self, keys: mx.array, values: mx.array):
+        keys = quantize_kv(keys, self.bits, self.group_size)
+        values = quantize_kv(values, self.bits, self.group_size)
+        if self.keys is None:
+            self.keys, self.values = tree_map(lambda x: x[:, :0], (keys, values))
+        self.reserve(self.offset + kv_arrays(keys)[0].shape[1])
+
+        prev = self.offset
+        self.offset += kv_arrays(keys)[0].shape[1]
+        for cache, new in zip(self.arrays(), kv_arrays(keys) + kv_arrays(values)):
+            cache[:, prev : self.offset] = new
+        return tree_map(lambda x: x[:, : self.offset], (self.keys, self.values))
+
+    def rearrange(self, source_indices: mx.array):
+        if self.keys is not None:
+            self.keys, self.values = tree_map(
+                lambda x: x[source_indices], (self.keys, self.values)
+            )
+
+    def shift_rows(self, rows: mx.array, shift: mx.array):
+        """
+        Keep the given rows, with the columns of each moved `shift` places to the
+        right, or to the left if negative; the offset is left to the caller
+        """
+        capacity = kv_arrays(self.keys)[0].shape[1]
+        columns = mx.arange(capacity)[None] - shift[:, None]
+        columns = mx.clip(columns, 0, capacity - 1)[..., None]
+        self.keys, self.values = tree_map(
+            lambda x: mx.take_along_axis(x[rows], columns, axis=1),
+            (self.keys, self.values),
+        )
+
+    def arrays(self) -> tuple:
+        """All the arrays that hold the keys and values"""
+        if self.keys is None:
+            return ()
+        return kv_arrays(self.keys) + kv_arrays(self.values)
 
 
 class Inference:
-    def __init__(self, model: "Whisper", initial_token_length: int):
+    def __init__(
+        self,
+        model: "Whisper",
+        kv_bits: Optional[int] = None,
+        kv_group_size: int = 64,
+    ):
         self.model: "Whisper" = model
-        self.initial_token_length = initial_token_length
+        # the self- and cross-attention caches are quantized to `kv_bits`
+        self.kv_bits = kv_bits
+        self.kv_group_size = kv_group_size
         self.kv_cache = None
+        # the number of padding columns on the left of each row, for rows with
+        # prompts of different lengths
+        self.padding: Optional[mx.array] = None
 
-    def logits(self, tokens: mx.array, audio_features: mx.array) -> mx.array:
-        """Perform a forward pass on the decoder and return per-token logits"""
-        if tokens.shape[-1] > self.initial_token_length:
-            # only need to use the last token except in the first forward pass
-            tokens = tokens[:, -1:]
+    def logits(
+        self,
+        tokens: mx.array,
+        audio_features: mx.array,
+        logit_positions: Optional[mx.array] = None,
+    ) -> mx.array:
+        """
+        Perform a forward pass on the decoder and return per-token logits, only
+        at `logit_positions` among the new tokens if given
+        """
+        offset = 0
+        if self.kv_cache is None:
+            cross_kv = self.cross_kv(audio_features)
+            self.kv_cache = [(self.new_cache(), kv) for kv in cross_kv]
+        else:
+            # only need to feed the tokens that are not in the cache yet
+            offset = self.kv_cache[0][0].offset
+            tokens = tokens[:, offset:]
+
+        positions = padding_mask = None
+        if self.padding is not None:
+            columns = mx.arange(offset + tokens.shape[1])
+            positions = mx.maximum(columns[None, offset:] - self.padding[:, None], 0)
+            padding_mask = columns[None] >= self.padding[:, None]
 
         logits, self.kv_cache, _ = self.model.decoder(
-            tokens, audio_features, kv_cache=self.kv_cache
+            tokens,
+            audio_features,
+            kv_cache=self.kv_cache,
+            positions=positions,
+            padding_mask=padding_mask,
+            logit_positions=logit_positions,
         )
         return logits.astype(mx.float32)
 
-    def rearrange_kv_cache(self, source_indices):
+    def rearrange_kv_cache(self, source_indices: mx.array):
         """Update the key-value cache according to the updated beams"""
-        # update the key/value cache to contain the selected sequences
-        if source_indices != list(range(len(source_indices))):
-            self.kv_cache = tree_map(lambda x: x[source_indices], self.kv_cache)
+        # update the self-attention caches to contain the selected sequences; the
+        # beams of an audio share its cross-attention keys and values
+        for kv, _ in self.kv_cache:
+            kv.rearrange(source_indices)
+        if self.padding is not None:
+            self.padding = self.padding[source_indices]
+
+    def keep_rows(self, indices: mx.array):
+        """Keep only the given rows in the self- and cross-attention caches"""
+        for i, (kv, cross_kv) in enumerate(self.kv_cache):
+            kv.rearrange(indices)
+            self.kv_cache[i] = (kv, tree_map(lambda x: x[indices], cross_kv))
+        if self.padding is not None:
+            self.padding = self.padding[indices]
+
+    def realign(self, rows: np.ndarray, padding: np.ndarray, length: int):
+        """
+        Keep only the given rows, now with `padding` columns on their left: the
+        cached columns of each row move by the change of its padding, and the
+        caches keep their first `length` columns, or fewer if a row was not
+        cached that far, e.g. after rows accepted different numbers of draft
+        tokens
+        """
+        previous = np.zeros(len(padding), np.int64)
+        if self.padding is not None:
+            previous = np.array(self.padding)[rows]
+        shift = padding - previous
+        self.padding = mx.array(padding)
+        if self.kv_cache is None:
+            return
+
+        index = mx.array(rows)
+        for i, (kv, cross_kv) in enumerate(self.kv_cache):
+            if shift.any():
+                kv.shift_rows(index, mx.array(shift))
+            else:
+                kv.rearrange(index)
+            kv.offset = min(length, kv.offset + int(shift.min()))
+            self.kv_cache[i] = (kv, tree_map(lambda x: x[index], cross_kv))
+
+    def load(self, prefill: Prefill, repeats: int = 1):
+        """Start from the caches of `prefill`, with each row repeated `repeats` times"""
+
+        def repeat(kv):
+            if kv is None or repeats == 1:
+                return kv
+            return tree_map(lambda x: mx.repeat(x, repeats, axis=0), kv)
+
+        self.kv_cache = []
+        for kv, cross_kv in zip(prefill.kv_cache, prefill.cross_kv):
+            cache = self.new_cache()
+            if kv is not None:
+                cache.keys, cache.values = repeat(kv)
+                cache.offset = kv_arrays(cache.keys)[0].shape[1]
+            self.kv_cache.append((cache, repeat(cross_kv)))
 
     def reset(self):
         self.kv_cache = None
 
+    def new_cache(self) -> KVCache:
+        """An empty self-attention cache of one layer"""
+        n_ctx = self.model.dims.n_text_ctx
+        return KVCache(n_ctx, self.kv_bits, self.kv_group_size)
+
+    def cross_kv(self, audio_features: mx.array):
+        """
+        The cross-attention keys and values of every layer, quantized as the
+        caches are. Those are then projected one audio at a time, so that the
+        fp16 projections of the whole batch are never held at once.
+        """
+        decoder = self.model.decoder
+        if self.kv_bits is None:
+            return decoder.cross_kv(audio_features)
+
+        n_audio = audio_features.shape[0]
+        cross_kv = None
+        for i in range(n_audio):
+            kv = [
+                tuple(quantize_kv(x, self.kv_bits, self.kv_group_size) for x in kv)
+                for kv in decoder.cross_kv(audio_features[i : i + 1])
+            ]
+            if cross_kv is None:
+                cross_kv = tree_map(
+                    lambda x: mx.zeros((n_audio, *x.shape[1:]), x.dtype), kv
+                )
+            for (_, x), (_, y) in zip(tree_flatten(cross_kv), tree_flatten(kv)):
+                x[i : i + 1] = y
+            mx.eval(cross_kv)
+        return cross_kv
+
+
+class StepKVCache:
+    """
+    A KVCache inside the compiled decode step: the new keys and values are
+    written at an offset given as an array, and attention runs over the whole
+    buffer, with the columns past the offset masked out by the caller.
+    """
+
+    def __init__(
+        self,
+        keys: mx.array,
+        values: mx.array,
+        offset: mx.array,
+        bits: Optional[int] = None,
+        group_size: int = 64,
+    ):
+        self.keys = keys
+        self.values = values
+        self.offset = offset
+        self.bits = bits
+        self.group_size = group_size
+
+    def update_and_fetch(self, keys: mx.array, values: mx.array):
+        def update(cache, new):
+            new = quantize_kv(new, self.bits, self.group_size)
+            return tree_map(
+                lambda x, y: mx.slice_update(x, y, self.offset, axes=(1,)), cache, new
+            )
+
+        self.keys = update(self.keys, keys)
+        self.values = update(self.values, values)
+        return self.keys, self.values
+
+
+class BlockAllocator:
+    """
+    The block tables of a batch of rows whose self-attention keys and values
+    are stored in a `PagedKVCache`, shared by its layers. A row is given blocks
+    of `block_size` columns from a pool of `n_blocks` as it grows, and returns
+    them when it is released, so that a short row does not hold the memory of
+    the longest one. Block 0 is never given out: the empty rows write into it
+    and the tables of the shorter rows are padded with it.
+    """
+
+    def __init__(self, n_batch: int, n_blocks: int, block_size: int = 16):
+        self.n_blocks = n_blocks
+        self.block_size = block_size
+        self.free = list(range(n_blocks - 1, 0, -1))
+        self.tables = [[] for _ in range(n_batch)]
+        self.lengths = np.zeros(n_batch, np.int64)  # the filled columns of each row
+
+        # set by `prepare()` for the next forward pass
+        self.table = None
+        self.write_blocks = None
+        self.write_offsets = None
+
+    def allocate(self, row: int, length: int) -> bool:
+        """Give `row` the blocks to hold `length` columns; False if the pool is short"""
+        n_new = -(-length // self.block_size) - len(self.tables[row])
+        if n_new > len(self.free):
+            return False
+        self.tables[row] += [self.free.pop() for _ in range(n_new)]
+        return True
+
+    def release(self, row: int):
+        self.free += reversed(self.tables[row])
+        self.tables[row] = []
+        self.lengths[row] = 0
+
+    def prepare(self, rows: np.ndarray):
+        """
+        Set up a forward pass of one new token per row, where the given rows
+        write theirs into the column after their filled ones; these must have
+        been allocated already
+        """
+        n_batch = len(self.tables)
+        table = np.zeros((n_batch, max(max(map(len, self.tables)), 1)), np.int64)
+        for row, blocks in enumerate(self.tables):
+            table[row, : len(blocks)] = blocks
+        write_blocks = np.zeros(n_batch, np.int64)
+        write_offsets = np.zeros(n_batch, np.int64)
+        block, offset = np.divmod(self.lengths[rows], self.block_size)
+        write_blocks[rows] = table[rows, block]
+        write_offsets[rows] = offset
+
+        self.table = mx.array(table)
+        self.write_blocks = mx.array(write_blocks)
+        self.write_offsets = mx.array(write_offsets)
+
+
+class PagedKVCache:
+    """
+    Self-attention key/value cache of one decoder layer, stored in the blocks
+    of a `BlockAllocator` rather than in `n_ctx` columns per row. Every forward
+    pass feeds one token per row, which is written into the row's next column;
+    attention then reads the blocks of each row back in order, padded to the
+    row with the most blocks, and the caller masks the columns past each row's
+    length. With `bits`, the keys and values are stored as `quantize_kv` does.
+    """
+
+    # rows are fed their own positions explicitly
+    offset = 0
+
+    def __init__(
+        self,
+        allocator: BlockAllocator,
+        n_state: int,
+        dtype: mx.Dtype = mx.float16,
+        bits: Optional[int] = None,
+        group_size: int = 64,
+    ):
+        self.allocator = allocator
+        self.bits = bits
+        self.group_size = group_size
+        shape = (allocator.n_blocks, allocator.block_size, n_state)
+        self.keys = quantize_kv(mx.zeros(shape, dtype), bits, group_size)
+        self.values = quantize_kv(mx.zeros(shape, dtype), bits, group_size)
+
+    def arrays(self) -> tuple:
+        """All the arrays that hold the keys and values"""
+        return kv_arrays(self.keys) + kv_arrays(self.values)
+
+    def fill(self, row: int, keys, values):
+        """
+        Write the first columns of `row`, which must have been allocated; keys
+        and values of shape (n_columns, n_state), or quantized already
+        """
+        n_columns = kv_arrays(keys)[0].shape[0]
+        block_size = self.allocator.block_size
+        n_blocks = -(-n_columns // block_size)
+        blocks = mx.array(self.allocator.tables[row][:n_blocks])
+        pad = n_blocks * block_size - n_columns
+        for x, new in zip(self.arrays(), kv_arrays(keys) + kv_arrays(values)):
+            new = mx.pad(new, [(0, pad), (0, 0)])
+            x[blocks] = new.reshape(n_blocks, block_size, -1)
+
+    def update_and_fetch(self, keys: mx.array, values: mx.array):
+        allocator = self.allocator
+        keys = quantize_kv(keys[:, 0], self.bits, self.group_size)
+        values = quantize_kv(values[:, 0], self.bits, self.group_size)
+        for x, new in zip(self.arrays(), kv_arrays(keys) + kv_arrays(values)):
+            x[allocator.write_blocks, allocator.write_offsets] = new
+
+        def gather(x):
+            x = x[allocator.table]
+            return x.reshape(x.shape[0], -1, x.shape[-1])
+
+        return tree_map(gather, (self.keys, self.values))
+
+
+def lookup_ngram(tokens: np.ndarray, max_ngram: int, n_tokens: int) -> np.ndarray:
+    """
+    The (up to) `n_tokens` tokens that followed the latest earlier occurrence
+    of the last n tokens of the row `tokens`, trying n from `max_ngram` down to 1
+    """
+    for n in range(min(max_ngram, len(tokens) - 1), 0, -1):
+        windows = np.lib.stride_tricks.sliding_window_view(tokens[:-1], n)
+        matches = np.flatnonzero((windows == tokens[-n:]).all(axis=-1))
+        if len(matches) > 0:
+            start = matches[-1] + n
+            return tokens[start : start + n_tokens]
+    return tokens[:0]
+
+
+def is_looping(text_tokens: List[int], n_tokens: int) -> bool:
+    """
+    Whether the last `n_tokens` tokens repeat the ones `period` tokens before
+    them, for a period of at most `n_tokens // 2`, so that the same phrase
+    occurs at least three times in a row
+    """
+    if len(text_tokens) < n_tokens + 1:
+        return False
+    tail = text_tokens[-n_tokens:]
+    return any(
+        text_tokens[-n_tokens - period : -period] == tail
+        for period in range(1, min(n_tokens // 2, len(text_tokens) - n_tokens) + 1)
+    )
+
+
+def batch_bucket(n_batch: int) -> int:
+    """The smallest of 1, 2, 3, 4, 6, 8, 12, 16, 24, ... that holds `n_batch` rows"""
+    size = 1
+    while size < n_batch:
+        if size & (size - 1):  # three times a power of two
+            size = size // 3 * 4
+        else:
+            size = max(size + size // 2, 2)
+    return size
+
+
+class CompiledDecodeStep:
+    """
+    The decoder forward pass for the newest tokens, the logit filters and the
+    greedy or sampling token selection of one step, as a single function
+    compiled with `mx.compile`. Every step after the first one then runs as one
+    graph instead of being dispatched op by op from Python.
+
+    The function is traced again for every new input shape. The self-attention
+    caches grow in blocks of `KVCache.step` columns and the caller pads the batch
+    to a `batch_bucket` size, so there are only a few shapes per model. The
+    compiled functions are kept for the most recent model, like `ModelHolder`
+    does for the model. The filters and the decoder are traced once per kind,
+    so their `step` and `select` may depend on their own attributes only
+    through constants of the model's vocabulary and the key below.
+    """
+
+    model = None
+    functions = {}
+
+    def __init__(
+        self,
+        model: "Whisper",
+        inference: Inference,
+        logit_filters: List["LogitFilter"],
+        decoder: "GreedyDecoder",
+    ):
+        self.model = model
+        self.inference = inference
+        self.logit_filters = logit_filters
+        self.decoder = decoder
+
+        cls = CompiledDecodeStep
+        if cls.model is not model:
+            cls.model = model
+            cls.functions = {}
+        key = (
+            tuple(type(f) for f in logit_filters),
+            decoder.eot,
+            decoder.temperature,
+            inference.kv_bits,
+            inference.kv_group_size,
+        )
+        if key not in cls.functions:
+            random_state = [mx.random.state]
+            cls.functions[key] = mx.compile(
+                self._step, inputs=random_state, outputs=random_state
+            )
+        self.function = cls.functions[key]
+
+    def _step(
+        self, tokens, offset, padding, kv_cache, audio_features, sum_logprobs, states
+    ):
+        bits, group_size = self.inference.kv_bits, self.inference.kv_group_size
+        caches = [
+            (StepKVCache(k, v, offset, bits, group_size), cross)
+            for (k, v), cross in kv_cache
+        ]
+        columns = mx.arange(kv_arrays(kv_cache[0][0][0])[0].shape[1])
+        logits, _, _ = self.model.decoder(
+            tokens,
+            audio_features,
+            kv_cache=caches,
+            positions=(offset - padding)[:, None],
+            padding_mask=(columns <= offset)[None]
+            & (columns[None] >= padding[:, None]),
+        )
+        logits = logits[:, -1].astype(mx.float32)
+
+        last_tokens = tokens[:, -1]
+        new_states = []
+        for logit_filter, state in zip(self.logit_filters, states):
+            logits, state = logit_filter.step(logits, last_tokens, state)
+            new_states.append(state)
+        next_tokens, sum_logprobs = self.decoder.select(
+            logits, last_tokens, sum_logprobs
+        )
+        new_kv = [(kv.keys, kv.values) for kv, _ in caches]
+        return next_tokens, sum_logprobs, new_kv, new_states
+
+    def __call__(
+        self, tokens: mx.array, audio_features: mx.array, sum_logprobs: mx.array
+    ) -> Tuple[mx.array, bool, mx.array]:
+        """Same as feeding the tokens to `Inference`, the filters and `update`"""
+        kv_cache = self.inference.kv_cache
+        offset = kv_cache[0][0].offset
+        for kv, _ in kv_cache:
+            kv.reserve(offset + 1)
+        padding = self.inference.padding
+        if padding is None:
+            padding = mx.zeros(tokens.shape[0], mx.int32)
+
+        next_tokens, sum_logprobs, new_kv, states = self.function(
+            tokens[:, -1:],
+            mx.array([offset]),
+            padding,
+            [((kv.keys, kv.values), cross) for kv, cross in kv_cache],
+            audio_features,
+            sum_logprobs,
+            [f.get_state() for f in self.logit_filters],
+        )
+
+        for (kv, _), (keys, values) in zip(kv_cache, new_kv):
+            kv.keys, kv.values = keys, values
+            kv.offset += 1
+        for logit_filter, state in zip(self.logit_filters, states):
+            logit_filter.set_state(state)
+
+        tokens = mx.concatenate([tokens, next_tokens[:, None]], axis=-1)
+        completed = mx.all(next_tokens == self.decoder.eot)
+        return tokens, completed, sum_logprobs
+
 
 class SequenceRanker:
     def rank(
@@ -229,7 +797,7 @@ class TokenDecoder:
 
     def finalize(
         self, tokens: mx.array, sum_logprobs: mx.array
-    ) -> Tuple[Sequence[Sequence[mx.array]], List[List[float]]]:
+    ) -> Tuple[Sequence[Sequence[List[int]]], List[List[float]]]:
         """Finalize search and return the final candidate sequences
 
         Parameters
@@ -242,8 +810,8 @@ class TokenDecoder:
 
         Returns
         -------
-        tokens : Sequence[Sequence[mx.array]], length = n_audio
-            sequence of mx.arrays containing candidate token sequences, for each audio input
+        tokens : Sequence[Sequence[List[int]]], length = n_audio
+            sequence of lists containing candidate token sequences, for each audio input
 
         sum_logprobs : List[List[float]], length = n_audio
             sequence of cumulative log probabilities corresponding to the above
@@ -260,29 +828,154 @@ class GreedyDecoder(TokenDecoder):
     def update(
         self, tokens: mx.array, logits: mx.array, sum_logprobs: mx.array
     ) -> Tuple[mx.array, bool, mx.array]:
+        next_tokens, sum_logprobs = self.select(logits, tokens[:, -1], sum_logprobs)
+        tokens = mx.concatenate([tokens, next_tokens[:, None]], axis=-1)
+
+        completed = mx.all(tokens[:, -1] == self.eot)
+        return tokens, completed, sum_logprobs
+
+    def select(
+        self, logits: mx.array, last_tokens: mx.array, sum_logprobs: mx.array
+    ) -> Tuple[mx.array, mx.array]:
+        """Pick the next tokens from the filtered logits; finished rows repeat EOT"""
         if self.temperature == 0:
             next_tokens = logits.argmax(axis=-1)
         else:
             next_tokens = mx.random.categorical(logits=logits / self.temperature)
 
-        next_tokens = mx.argmax(logits, axis=-1)
         logits = logits.astype(mx.float32)
         logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
 
         current_logprobs = logprobs[mx.arange(logprobs.shape[0]), next_tokens]
-        sum_logprobs += current_logprobs * (tokens[:, -1] != self.eot)
+        sum_logprobs = sum_logprobs + current_logprobs * (last_tokens != self.eot)
 
-        eot_mask = tokens[:, -1] == self.eot
+        eot_mask = last_tokens == self.eot
         next_tokens = next_tokens * (1 - eot_mask) + self.eot * eot_mask
-        tokens = mx.concatenate([tokens, next_tokens[:, None]], axis=-1)
-
-        completed = mx.all(tokens[:, -1] == self.eot)
-        return tokens, completed, sum_logprobs
+        return next_tokens, sum_logprobs
 
     def finalize(self, tokens: mx.array, sum_logprobs: mx.array):
         # make sure each sequence has at least one EOT token at the end
         tokens = mx.pad(tokens, [(0, 0), (0, 0), (0, 1)], constant_values=self.eot)
-        return tokens, sum_logprobs.tolist()
+        return tokens.tolist(), sum_logprobs.tolist()
+
+
+class BeamSearchDecoder(TokenDecoder):
+    """
+    Beam search over all audio inputs at once: the n_audio * beam_size
+    hypotheses are decoded as a single batch, and the beams are selected with
+    array operations over the whole batch. Only the few candidates that end
+    with EOT are brought back to the host, to be kept as finished sequences.
+    """
+
+    def __init__(
+        self,
+        beam_size: int,
+        eot: int,
+        rearrange: Callable[[mx.array], None],
+        patience: Optional[float] = None,
+    ):
+        self.beam_size = beam_size
+        self.eot = eot
+        self.rearrange = rearrange
+        self.patience = patience or 1.0
+        self.max_candidates: int = round(beam_size * self.patience)
+        self.finished_sequences = None
+
+        assert (
+            self.max_candidates > 0
+        ), f"Invalid beam size ({beam_size}) or patience ({patience})"
+
+    def reset(self):
+        self.finished_sequences = None
+
+    def update(
+        self, tokens: mx.array, logits: mx.array, sum_logprobs: mx.array
+    ) -> Tuple[mx.array, bool, mx.array]:
+        if tokens.shape[0] % self.beam_size != 0:
+            raise ValueError(f"{tokens.shape}[0] % {self.beam_size} != 0")
+
+        n_audio = tokens.shape[0] // self.beam_size
+        n_vocab = logits.shape[-1]
+        n_candidates = 2 * self.beam_size
+        if self.finished_sequences is None:  # for the first update
+            self.finished_sequences = [{} for _ in range(n_audio)]
+            # all beams of an audio start from the same tokens; expand only the first
+            first_beam = mx.arange(tokens.shape[0]) % self.beam_size == 0
+            sum_logprobs = mx.where(first_beam, sum_logprobs, -np.inf)
+
+        logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+        scores = (sum_logprobs[:, None] + logprobs).reshape(n_audio, -1)
+
+        # the best candidates of each audio over all of its beams, best first;
+        # every beam has a single EOT candidate, so at least beam_size of them
+        # do not end the sequence
+        candidates = mx.argpartition(-scores, kth=n_candidates - 1, axis=-1)
+        candidates = candidates[:, :n_candidates].astype(mx.int32)
+        candidate_scores = mx.take_along_axis(scores, candidates, axis=-1)
+        order = mx.argsort(-candidate_scores, axis=-1)
+        candidates = mx.take_along_axis(candidates, order, axis=-1)
+        candidate_scores = mx.take_along_axis(candidate_scores, order, axis=-1)
+        candidate_tokens = candidates % n_vocab
+        source_indices = (
+            candidates // n_vocab + mx.arange(n_audio)[:, None] * self.beam_size
+        )
+
+        # the beam_size best candidates that do not end with EOT become the new beams
+        is_eot = candidate_tokens == self.eot
+        continues = (~is_eot).astype(mx.int32)
+        keep = mx.argsort(is_eot * n_candidates + mx.arange(n_candidates), axis=-1)
+        keep = keep[:, : self.beam_size]
+        next_tokens = mx.take_along_axis(candidate_tokens, keep, axis=-1).flatten()
+        sum_logprobs = mx.take_along_axis(candidate_scores, keep, axis=-1).flatten()
+        source = mx.take_along_axis(source_indices, keep, axis=-1).flatten()
+
+        # the EOT candidates ranked above the last new beam are finished sequences
+        finished = is_eot & (
+            mx.cumsum(continues, axis=-1, inclusive=False) < keep.shape[-1]
+        )
+        finished = np.array(finished)
+        if finished.any():
+            audio_indices, candidate_indices = finished.nonzero()
+            rows = np.array(source_indices)[audio_indices, candidate_indices]
+            prefixes = np.array(tokens[mx.array(rows)]).tolist()
+            scores = np.array(candidate_scores)[audio_indices, candidate_indices]
+            for i, prefix, score in zip(audio_indices, prefixes, scores.tolist()):
+                if len(self.finished_sequences[i]) < self.max_candidates:
+                    self.finished_sequences[i][tuple(prefix + [self.eot])] = score
+
+        tokens = mx.concatenate(
+            [tokens[source], next_tokens[:, None].astype(tokens.dtype)], axis=-1
+        )
+        self.rearrange(source)
+
+        completed = all(
+            len(sequences) >= self.max_candidates
+            for sequences in self.finished_sequences
+        )
+        return tokens, completed, sum_logprobs
+
+    def finalize(self, preceding_tokens: mx.array, sum_logprobs: mx.array):
+        # collect all finished sequences, including patience, and add unfinished ones if not enough
+        preceding_tokens = preceding_tokens.tolist()
+        sum_logprobs = sum_logprobs.tolist()
+        for i, sequences in enumerate(self.finished_sequences):
+            if (
+                len(sequences) < self.beam_size
+            ):  # when not enough sequences are finished
+                for j in np.argsort(sum_logprobs[i])[::-1]:
+                    sequence = preceding_tokens[i][j] + [self.eot]
+                    sequences[tuple(sequence)] = sum_logprobs[i][j]
+                    if len(sequences) >= self.beam_size:
+                        break
+
+        tokens: List[List[List[int]]] = [
+            [list(sequence) for sequence in sequences.keys()]
+            for sequences in self.finished_sequences
+        ]
+        sum_logprobs: List[List[float]] = [
+            list(sequences.values()) for sequences in self.finished_sequences
+        ]
+        return tokens, sum_logprobs
 
 
 class LogitFilter:
@@ -300,97 +993,220 @@ class LogitFilter:
         """
         raise NotImplementedError
 
+    def rearrange(self, source_indices: mx.array):
+        """Reorder any per-row state according to the updated beams"""
 
-class SuppressBlank(LogitFilter):
-    def __init__(self, tokenizer: Tokenizer, sample_begin: int, n_vocab: int):
-        self.sample_begin = sample_begin
-        mask = np.zeros(n_vocab, np.float32)
-        mask[tokenizer.encode(" ") + [tokenizer.eot]] = -np.inf
-        self.mask = mx.array(mask)
+    def get_state(self) -> Tuple[mx.array, ...]:
+        """The arrays `step` depends on, besides constants of the model's vocabulary"""
+        return ()
 
-    def apply(self, logits: mx.array, tokens: mx.array) -> mx.array:
-        if tokens.shape[1] == self.sample_begin:
-            return logits + self.mask
-        return logits
+    def set_state(self, state: Tuple[mx.array, ...]):
+        """Store the state returned by `step`"""
+
+    def restore_rows(self, rows: mx.array, state: Tuple[mx.array, ...]):
+        """Go back to `state`, from an earlier `get_state`, in the given rows only"""
+
+    def step(
+        self, logits: mx.array, last_tokens: mx.array, state: Tuple[mx.array, ...]
+    ) -> Tuple[mx.array, Tuple[mx.array, ...]]:
+        """`apply` for a step after the first sampled token, as a pure function of
+        the newest tokens and the state, so that it can be compiled with `mx.compile`
+        """
+        raise NotImplementedError
 
 
-class SuppressTokens(LogitFilter):
-    def __init__(self, suppress_tokens: Sequence[int], n_vocab: int):
+class SuppressBlankAndTokens(LogitFilter):
+    """
+    The SuppressBlank and SuppressTokens filters of openai-whisper folded into
+    precomputed additive masks: one for the first sampled position, where
+    blanks are suppressed as well, and one for every later position.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Tokenizer,
+        sample_begin: int,
+        n_vocab: int,
+        suppress_tokens: Sequence[int] = (),
+        suppress_blank: bool = True,
+    ):
+        self.sample_begin = sample_begin
         mask = np.zeros(n_vocab, np.float32)
         mask[list(suppress_tokens)] = -np.inf
+        initial_mask = mask.copy()
+        if suppress_blank:
+            initial_mask[tokenizer.encode(" ") + [tokenizer.eot]] = -np.inf
         self.mask = mx.array(mask)
+        self.initial_mask = mx.array(initial_mask)
 
     def apply(self, logits: mx.array, tokens: mx.array) -> mx.array:
+        first = tokens.shape[1] == self.sample_begin
+        if isinstance(first, mx.array):
+            # per-row sample_begin, for rows that started sampling at different steps
+            return logits + mx.where(first[:, None], self.initial_mask, self.mask)
+        if first:
+            return logits + self.initial_mask
         return logits + self.mask
 
+    def get_state(self):
+        return (self.mask,)
+
+    def step(self, logits, last_tokens, state):
+        return logits + state[0], state
+
 
 class ApplyTimestampRules(LogitFilter):
+    """
+    Applies the timestamp rules to the whole batch at once. The per-row state
+    the rules depend on (the last timestamp, and whether the last two tokens
+    were timestamps) is updated from the newly sampled tokens on every call
+    instead of being recovered from the token history.
+    """
+
     def __init__(
         self,
         tokenizer: Tokenizer,
         sample_begin: int,
         max_initial_timestamp_index: Optional[int],
+        n_vocab: int,
     ):
         self.tokenizer = tokenizer
         self.sample_begin = sample_begin
         self.max_initial_timestamp_index = max_initial_timestamp_index
 
-    def apply(self, logits: mx.array, tokens: mx.array) -> mx.array:
-        mask = np.zeros(logits.shape, np.float32)
+        timestamp_begin = tokenizer.timestamp_begin
+        mask = np.zeros(n_vocab, np.float32)
         # suppress <|notimestamps|> which is handled by without_timestamps
-        if self.tokenizer.no_timestamps is not None:
-            mask[:, self.tokenizer.no_timestamps] = -np.inf
-
-        # timestamps have to appear in pairs, except directly before EOT; mask logits accordingly
-        for k in range(tokens.shape[0]):
-            sampled_tokens = tokens[k, self.sample_begin :]
-            seq = sampled_tokens.tolist()
-            last_was_timestamp = (
-                len(seq) >= 1 and seq[-1] >= self.tokenizer.timestamp_begin
-            )
-            penultimate_was_timestamp = (
-                len(seq) < 2 or seq[-2] >= self.tokenizer.timestamp_begin
+        if tokenizer.no_timestamps is not None:
+            mask[tokenizer.no_timestamps] = -np.inf
+
+        # suppress generating non-timestamp tokens at the beginning
+        initial_mask = mask.copy()
+        initial_mask[:timestamp_begin] = -np.inf
+        # apply the `max_initial_timestamp` option
+        if max_initial_timestamp_index is not None:
+            last_allowed = timestamp_begin + max_initial_timestamp_index
+            initial_mask[last_allowed + 1 :] = -np.inf
+
+        self.mask = mx.array(mask)
+        self.initial_mask = mx.array(initial_mask)
+        self.vocab = mx.arange(n_vocab)
+        self.is_timestamp = self.vocab >= timestamp_begin
+        self.is_text = self.vocab < tokenizer.eot
+
+        self.n_sampled = 0
+        self.last_was_timestamp = None
+        self.penultimate_was_timestamp = None
+        self.last_timestamp = None
+
+    def _update_state(self, tokens: mx.array):
+        first = tokens.shape[1] == self.sample_begin
+        if isinstance(first, mx.array):
+            # per-row sample_begin, for rows that started sampling at different
+            # steps: restart the rows sampling their first token, and advance the
+            # others by the single token appended since the previous call
+            if self.last_timestamp is None:
+                self._reset_state(tokens)
+            last, penultimate, last_timestamp = self._advance(
+                tokens[:, -1], self.get_state()
             )
+            self.penultimate_was_timestamp = first | penultimate
+            self.last_was_timestamp = first | last
+            self.last_timestamp = mx.where(first, 0, last_timestamp)
+            return first
 
-            if last_was_timestamp:
-                if penultimate_was_timestamp:  # has to be non-timestamp
-                    mask[k, self.tokenizer.timestamp_begin :] = -np.inf
-                else:  # cannot be normal text tokens
-                    mask[k, : self.tokenizer.eot] = -np.inf
+        if first:
+            self._reset_state(tokens)
+            return first
 
-            timestamps = [
-                i for i, v in enumerate(seq) if v > self.tokenizer.timestamp_begin
-            ]
-            if len(timestamps) > 0:
-                # timestamps shouldn't decrease; forbid timestamp tokens smaller than the last
-                # also force each segment to have a nonzero length, to prevent infinite looping
-                last_timestamp = timestamps[-1]
-                if not last_timestamp or penultimate_was_timestamp:
-                    last_timestamp += 1
-                mask[k, self.tokenizer.timestamp_begin : last_timestamp] = -np.inf
-
-        if tokens.shape[1] == self.sample_begin:
-            # suppress generating non-timestamp tokens at the beginning
-            mask[:, : self.tokenizer.timestamp_begin] = -np.inf
-
-            # apply the `max_initial_timestamp` option
-            if self.max_initial_timestamp_index is not None:
-                last_allowed = (
-                    self.tokenizer.timestamp_begin + self.max_initial_timestamp_index
-                )
-                mask[:, last_allowed + 1 :] = -np.inf
+        for i in range(self.sample_begin + self.n_sampled, tokens.shape[1]):
+            self.set_state(self._advance(tokens[:, i], self.get_state()))
+        self.n_sampled = tokens.shape[1] - self.sample_begin
+        return first
 
-        # if sum of probability over timestamps is above any other token, sample timestamp
-        logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
-        for k in range(tokens.shape[0]):
-            timestamp_logprob = logprobs[k, self.tokenizer.timestamp_begin :].logsumexp(
-                axis=-1
-            )
-            max_text_token_logprob = logprobs[k, : self.tokenizer.timestamp_begin].max()
-            if timestamp_logprob > max_text_token_logprob:
-                mask[k, : self.tokenizer.timestamp_begin] = -np.inf
+    def _reset_state(self, tokens: mx.array):
+        n_batch = tokens.shape[0]
+        self.n_sampled = 0
+        # before two tokens are sampled the sequence start counts as a
+        # timestamp, so that a single leading timestamp may be followed by text
+        self.last_was_timestamp = mx.ones(n_batch, mx.bool_)
+        self.penultimate_was_timestamp = mx.ones(n_batch, mx.bool_)
+        # 0 stands for "no timestamp yet", as every timestamp token is larger
+        self.last_timestamp = mx.zeros(n_batch, tokens.dtype)
+
+    def _advance(self, token: mx.array, state: Tuple[mx.array, ...]):
+        last_was_timestamp, _, last_timestamp = state
+        is_timestamp = token >= self.tokenizer.timestamp_begin
+        last_timestamp = mx.where(is_timestamp, token, last_timestamp)
+        return is_timestamp, last_was_timestamp, last_timestamp
+
+    def _apply_rules(self, logits: mx.array, state: Tuple[mx.array, ...]):
+        last_was_timestamp, penultimate_was_timestamp, last_timestamp = state
+        last = last_was_timestamp[:, None]
+        penultimate = penultimate_was_timestamp[:, None]
+
+        # timestamps have to appear in pairs, except directly before EOT; a pair
+        # has to be followed by a non-timestamp, a single one cannot be followed
+        # by normal text tokens
+        suppress = (last & penultimate & self.is_timestamp) | (
+            last & ~penultimate & self.is_text
+        )
+
+        # timestamps shouldn't decrease; forbid timestamp tokens smaller than the last
+        # also force each segment to have a nonzero length, to prevent infinite looping
+        timestamp_last = mx.where(
+            last_was_timestamp & ~penultimate_was_timestamp,
+            last_timestamp,
+            last_timestamp + 1,
+        )
+        suppress = suppress | (
+            self.is_timestamp & (self.vocab < timestamp_last[:, None])
+        )
+        logits = mx.where(suppress, -np.inf, logits + self.mask)
+
+        # if sum of probability over timestamps is above any other token, sample
+        # timestamp; the log-softmax normalizer is shared and cancels out
+        timestamp_begin = self.tokenizer.timestamp_begin
+        timestamp_logprob = mx.logsumexp(logits[:, timestamp_begin:], axis=-1)
+        max_text_token_logprob = logits[:, :timestamp_begin].max(axis=-1)
+        sample_timestamp = timestamp_logprob > max_text_token_logprob
+        return mx.where(sample_timestamp[:, None] & ~self.is_timestamp, -np.inf, logits)
+
+    def rearrange(self, source_indices: mx.array):
+        self.set_state(tuple(x[source_indices] for x in self.get_state()))
+
+    def get_state(self):
+        return (
+            self.last_was_timestamp,
+            self.penultimate_was_timestamp,
+            self.last_timestamp,
+        )
+
+    def set_state(self, state):
+        (
+            self.last_was_timestamp,
+            self.penultimate_was_timestamp,
+            self.last_timestamp,
+        ) = state
 
-        return logits + mx.array(mask, logits.dtype)
+    def restore_rows(self, rows, state):
+        self.set_state(
+            tuple(mx.where(rows, old, new) for old, new in zip(state, self.get_state()))
+        )
+
+    def step(self, logits, last_tokens, state):
+        state = self._advance(last_tokens, state)
+        return self._apply_rules(logits, state), state
+
+    def apply(self, logits: mx.array, tokens: mx.array) -> mx.array:
+        first = self._update_state(tokens)
+        if first is True:
+            return logits + self.initial_mask
+
+        rule_logits = self._apply_rules(logits, self.get_state())
+        if isinstance(first, mx.array):
+            return mx.where(first[:, None], logits + self.initial_mask, rule_logits)
+        return rule_logits
 
 
 class DecodingTask:
@@ -399,7 +1215,12 @@ class DecodingTask:
     decoder: TokenDecoder
     logit_filters: List[LogitFilter]
 
-    def __init__(self, model: "Whisper", options: DecodingOptions):
+    def __init__(
+        self,
+        model: "Whisper",
+        options: DecodingOptions,
+        draft_model: Optional["Whisper"] = None,
+    ):
         self.model = model
 
         language = options.language or "en"
@@ -420,34 +1241,32 @@ class DecodingTask:
         if self.options.without_timestamps:
             self.sot_sequence = tokenizer.sot_sequence_including_notimestamps
 
-        self.initial_tokens: Tuple[int] = self._get_initial_tokens()
-        self.sample_begin: int = len(self.initial_tokens)
-        self.sot_index: int = self.initial_tokens.index(tokenizer.sot)
-
-        # inference: implements the forward pass through the decoder, including kv caching
-        self.inference = Inference(model, len(self.initial_tokens))
+        # initial tokens and inference, which implements the forward pass through
+        # the decoder, including kv caching
+        self.logit_filters = []
+        self.prepare(options.prompt, draft_model)
 
         # sequence ranker: implements how to rank a group of sampled sequences
         self.sequence_ranker = MaximumLikelihoodRanker(options.length_penalty)
 
         # decoder: implements how to select the next tokens, given the autoregressive distribution
         if options.beam_size is not None:
-            raise NotImplementedError("Beam search decoder is not yet implemented")
-            # self.decoder = BeamSearchDecoder(
-            #    options.beam_size, tokenizer.eot, self.inference, options.patience
-            # )
+            self.decoder = BeamSearchDecoder(
+                options.beam_size, tokenizer.eot, self._rearrange, options.patience
+            )
         else:
             self.decoder = GreedyDecoder(options.temperature, tokenizer.eot)
 
         # logit filters: applies various rules to suppress or penalize certain tokens
-        self.logit_filters = []
-        if self.options.suppress_blank:
-            self.logit_filters.append(
-                SuppressBlank(self.tokenizer, self.sample_begin, model.dims.n_vocab)
-            )
-        if self.options.suppress_tokens:
+        if self.options.suppress_blank or self.options.suppress_tokens:
             self.logit_filters.append(
-                SuppressTokens(self._get_suppress_tokens(), model.dims.n_vocab)
+                SuppressBlankAndTokens(
+                    self.tokenizer,
+                    self.sample_begin,
+                    model.dims.n_vocab,
+                    self._get_suppress_tokens() if options.suppress_tokens else (),
+                    options.suppress_blank,
+                )
             )
         if not options.without_timestamps:
             precision = CHUNK_LENGTH / model.dims.n_audio_ctx  # usually 0.02 seconds
@@ -458,7 +1277,10 @@ class DecodingTask:
                 )
             self.logit_filters.append(
                 ApplyTimestampRules(
-                    tokenizer, self.sample_begin, max_initial_timestamp_index
+                    tokenizer,
+                    self.sample_begin,
+                    max_initial_timestamp_index,
+                    model.dims.n_vocab,
                 )
             )
 
@@ -470,14 +1292,80 @@ class DecodingTask:
                 raise ValueError("best_of with greedy sampling (T=0) is not compatible")
         if options.patience is not None and options.beam_size is None:
             raise ValueError("patience requires beam_size to be given")
+        if options.prompt_lookup is not None:
+            if options.temperature != 0 or options.beam_size is not None:
+                raise ValueError("prompt lookup requires greedy sampling (T=0)")
+            if options.prompt_lookup < 1:
+                raise ValueError("prompt_lookup should be at least 1")
+        if options.loop_tokens is not None and options.loop_tokens < 2:
+            raise ValueError("loop_tokens should be at least 2")
+        if options.max_tokens_per_second is not None:
+            if options.max_tokens_per_second <= 0:
+                raise ValueError("max_tokens_per_second should be positive")
         if options.length_penalty is not None and not (
             0 <= options.length_penalty <= 1
         ):
             raise ValueError("length_penalty (alpha) should be a value between 0 and 1")
+        if options.kv_bits is not None:
+            if options.kv_bits not in (4, 8):
+                raise ValueError("kv_bits should be 4 or 8")
+            head_dim = self.model.dims.n_text_state // self.model.dims.n_text_head
+            if head_dim % options.kv_group_size != 0:
+                raise ValueError(
+                    f"kv_group_size should divide the attention head size {head_dim}"
+                )
 
         return options
 
-    def _get_initial_tokens(self) -> Tuple[int]:
+    def prepare(
+        self,
+        prompt: Optional[Union[str, List[int], List[Union[str, List[int]]]]] = None,
+        draft_model: Optional["Whisper"] = None,
+    ):
+        """
+        Set up the initial tokens for `prompt`, which replaces `options.prompt`,
+        and fresh caches; the tokenizer, the decoder and the logit filters are
+        kept, so that a task can run again with another prompt.
+
+        `prompt` may also be a list with one prompt for each audio. The initial
+        tokens of the shorter ones are then padded on the left, so that every
+        row starts sampling at the same column.
+        """
+        if draft_model is not None:
+            if self.options.temperature != 0 or self.options.beam_size is not None:
+                raise ValueError("speculative decoding requires greedy sampling (T=0)")
+            if draft_model.dims.n_vocab != self.model.dims.n_vocab:
+                raise ValueError("the draft model must share the model's vocabulary")
+
+        if isinstance(prompt, list) and prompt and not isinstance(prompt[0], int):
+            initial_tokens = [self._get_initial_tokens(p) for p in prompt]
+        else:
+            initial_tokens = [self._get_initial_tokens(prompt)]
+        self.sample_begin: int = max(map(len, initial_tokens))
+        self.padding = np.array([self.sample_begin - len(t) for t in initial_tokens])
+        self.initial_tokens: np.ndarray = np.array(
+            [
+                (self.tokenizer.eot,) * p + t
+                for p, t in zip(self.padding, initial_tokens)
+            ]
+        )
+        self.sot_index: np.ndarray = self.padding + np.array(
+            [t.index(self.tokenizer.sot) for t in initial_tokens]
+        )
+        for logit_filter in self.logit_filters:
+            logit_filter.sample_begin = self.sample_begin
+
+        self.inference = Inference(
+            self.model, self.options.kv_bits, self.options.kv_group_size
+        )
+        self.draft_model = draft_model
+        if draft_model is not None:
+            self.draft_inference = Inference(draft_model)
+
+    def _get_initial_tokens(
+        self, prompt: Optional[Union[str, List[int]]] = None
+    ) -> Tuple[int]:
+        """`prompt`, when given, replaces `options.prompt` for this sequence"""
         tokens = list(self.sot_sequence)
 
         if prefix := self.options.prefix:
@@ -491,7 +1379,7 @@ class DecodingTask:
                 prefix_tokens = prefix_tokens[-max_prefix_len:]
             tokens = tokens + prefix_tokens
 
-        if prompt := self.options.prompt:
+        if prompt := prompt or self.options.prompt:
             prompt_tokens = (
                 self.tokenizer.encode(" " + prompt.strip())
                 if isinstance(prompt, str)
@@ -554,6 +1442,21 @@ class DecodingTask:
 
         return audio_features
 
+    def _get_draft_audio_features(self, mel: mx.array, audio_features: mx.array):
+        dims, draft_dims = self.model.dims, self.draft_model.dims
+        if (draft_dims.n_audio_ctx, draft_dims.n_audio_state) == (
+            dims.n_audio_ctx,
+            dims.n_audio_state,
+        ):
+            # distilled checkpoints keep the encoder of the model they come from
+            return audio_features
+
+        if mel.shape[-2:] == (dims.n_audio_ctx, dims.n_audio_state):
+            raise ValueError("the draft model can't use the given audio features")
+        if self.options.fp16:
+            mel = mel.astype(mx.float16)
+        return self.draft_model.encoder(mel)
+
     def _detect_language(self, audio_features: mx.array, tokens: np.array):
         languages = [self.options.language] * audio_features.shape[0]
         lang_probs = None
@@ -565,60 +1468,447 @@ class DecodingTask:
             languages = [max(probs, key=probs.get) for probs in lang_probs]
             if self.options.language is None:
                 # write language tokens
-                tokens[:, self.sot_index + 1] = np.array(lang_tokens)
+                sot_index = np.broadcast_to(self.sot_index, len(tokens))
+                tokens[np.arange(len(tokens)), sot_index + 1] = np.array(lang_tokens)
 
         return languages, lang_probs
 
-    def _main_loop(self, audio_features: mx.array, tokens: mx.array):
+    def _no_speech_probs(
+        self, logits: mx.array, no_speech_probs: List[float]
+    ) -> Union[List[float], mx.array]:
+        """
+        Fill in the no-speech probability of the rows whose startoftranscript
+        token is the last initial token, from the `logits` of that token; the
+        result stays on the device, so that the decoding need not wait for it
+        """
+        if self.tokenizer.no_speech is None or not np.isnan(no_speech_probs).any():
+            return no_speech_probs
+        probs = mx.softmax(logits.astype(mx.float32), axis=-1)
+        no_speech_probs = mx.array(no_speech_probs, mx.float32)
+        return mx.where(
+            mx.isnan(no_speech_probs),
+            probs[:, self.tokenizer.no_speech],
+            no_speech_probs,
+        )
+
+    def _sample_lens(self, durations: Optional[Sequence[float]], n_rows: int):
+        """
+        The number of tokens each row may sample: `sample_len`, or fewer for
+        short windows when `durations` (in seconds) and `max_tokens_per_second`
+        are given
+        """
+        sample_lens = np.full(n_rows, self.sample_len)
+        tokens_per_second = self.options.max_tokens_per_second
+        if durations is not None and len(durations) != n_rows:
+            raise ValueError(
+                f"got {len(durations)} durations for {n_rows} audio inputs"
+            )
+        if durations is not None and tokens_per_second is not None:
+            budget = np.ceil(np.asarray(durations) * tokens_per_second).astype(int)
+            sample_lens = np.clip(budget, 1, self.sample_len)
+        return sample_lens
+
+    def _end_rows(self, logits: mx.array, tokens: mx.array, sample_lens: mx.array):
+        """
+        Force EOT in the rows of `tokens` that sampled all their tokens; the
+        logit filters may have masked EOT too, so the row logits are replaced
+        """
+        ended = tokens.shape[-1] - self.sample_begin >= sample_lens
+        not_eot = mx.arange(logits.shape[-1]) != self.tokenizer.eot
+        return mx.where(ended[:, None], mx.where(not_eot, -np.inf, 0.0), logits)
+
+    def _rearrange(self, source_indices: mx.array):
+        """Reorder the per-row decoding state according to the updated beams"""
+        self.inference.rearrange_kv_cache(source_indices)
+        for logit_filter in self.logit_filters:
+            logit_filter.rearrange(source_indices)
+
+    def _compact(self, keep: mx.array):
+        """Drop the rows that are not in `keep` from the per-row decoding state"""
+        self.inference.keep_rows(keep)
+        for logit_filter in self.logit_filters:
+            logit_filter.rearrange(keep)
+
+    def _main_loop(
+        self,
+        audio_features: mx.array,
+        tokens: mx.array,
+        no_speech_probs: List[float],
+        sample_lens: np.ndarray,
+    ):
+        """
+        Sample up to `sample_lens` tokens in each row; a row leaves the batch
+        once it is done, except in beam search, where its beams end with EOT
+        """
         n_batch = tokens.shape[0]
         sum_logprobs: mx.array = mx.zeros(n_batch)
-        no_speech_probs = [np.nan] * n_batch
+        eot = self.tokenizer.eot
+
+        # independently sampled rows leave the batch once they emit EOT; `rows`
+        # holds the original index of the rows that are still decoding
+        compact = isinstance(self.decoder, GreedyDecoder)
+        rows = np.arange(n_batch)
+        finished = {}
+
+        # with `loop_tokens`, the rows also leave once their text, without the
+        # timestamps, repeats itself; they are marked in `looped`
+        loop_tokens = self.options.loop_tokens if compact else None
+        text_tokens = [[] for _ in range(n_batch)]
+        looped = np.zeros(n_batch, dtype=bool)
+
+        # the compiled step runs on a batch padded to a bucket size with copies
+        # of a live row, which are marked with -1 in `rows`
+        limits = None
+        if not compact and (sample_lens < self.sample_len).any():
+            limits = mx.array(sample_lens)
+
+        step = None
+        if compact and self.options.compile_step:
+            step = CompiledDecodeStep(
+                self.model, self.inference, self.logit_filters, self.decoder
+            )
 
         try:
-            for i in range(self.sample_len):
-                logits = self.inference.logits(tokens, audio_features)
-
-                if (
-                    i == 0 and self.tokenizer.no_speech is not None
-                ):  # save no_speech_probs
-                    probs_at_sot = mx.softmax(
-                        logits[:, self.sot_index].astype(mx.float32), axis=-1
+            for i in range(int(sample_lens.max())):
+                previous, previous_logprobs = tokens, sum_logprobs
+                if step is not None and i > 0:
+                    tokens, completed, sum_logprobs = step(
+                        tokens, audio_features, sum_logprobs
                     )
-                    no_speech_probs = probs_at_sot[:, self.tokenizer.no_speech].tolist()
+                else:
+                    logits = self.inference.logits(tokens, audio_features)
 
-                # now we need to consider the logits at the last token only
-                logits = logits[:, -1]
+                    if i == 0:  # save no_speech_probs
+                        no_speech_probs = self._no_speech_probs(
+                            logits[:, 0], no_speech_probs
+                        )
 
-                # apply the logit filters, e.g. for suppressing or applying penalty to
-                for logit_filter in self.logit_filters:
-                    logits = logit_filter.apply(logits, tokens)
+                    # now we need to consider the logits at the last token only
+                    logits = logits[:, -1]
 
-                # expand the tokens tensor with the selected next tokens
-                tokens, completed, sum_logprobs = self.decoder.update(
-                    tokens, logits, sum_logprobs
-                )
+                    # apply the logit filters, e.g. for suppressing or applying penalty to
+                    for logit_filter in self.logit_filters:
+                        logits = logit_filter.apply(logits, tokens)
+                    if limits is not None:
+                        logits = self._end_rows(logits, tokens, limits)
+
+                    # expand the tokens tensor with the selected next tokens
+                    tokens, completed, sum_logprobs = self.decoder.update(
+                        tokens, logits, sum_logprobs
+                    )
 
-                if completed or tokens.shape[-1] > self.n_ctx:
+                # `completed` is only read in beam search: reading it waits for
+                # the step, which the compacting loop leaves running instead
+                if (not compact and completed) or tokens.shape[-1] > self.n_ctx:
                     break
+
+                if compact:
+                    # queue this step, and look at the tokens of the previous
+                    # one while it runs; the rows that are found done then
+                    # only added an EOT in this step, and are kept as they
+                    # were before it
+                    mx.async_eval(tokens, sum_logprobs)
+                    last = np.array(previous[:, -1])
+                    padding = rows < 0
+                    done = (last == eot) & (i > 0)
+                    done |= ~padding & (sample_lens[rows] <= i)
+                    if loop_tokens is not None and i > 0:
+                        for row in np.flatnonzero(~done & ~padding):
+                            if last[row] < eot:
+                                text_tokens[rows[row]].append(int(last[row]))
+                                if is_looping(text_tokens[rows[row]], loop_tokens):
+                                    looped[rows[row]] = done[row] = True
+                    if done.any() or (step is not None and i == 0):
+                        for row in np.flatnonzero(done & ~padding):
+                            finished[rows[row]] = (
+                                previous[row],
+                                previous_logprobs[row],
+                            )
+                        keep = np.flatnonzero(~done & ~padding)
+                        rows = rows[keep]
+                        if len(rows) == 0:
+                            break
+                        if step is not None:
+                            n_padding = batch_bucket(len(keep)) - len(keep)
+                            keep = np.concatenate([keep, np.full(n_padding, keep[0])])
+                            rows = np.concatenate([rows, np.full(n_padding, -1)])
+                        keep = mx.array(keep)
+                        tokens, sum_logprobs = tokens[keep], sum_logprobs[keep]
+                        audio_features = audio_features[keep]
+                        self._compact(keep)
         finally:
             self.inference.reset()
 
-        return tokens, sum_logprobs, no_speech_probs
+        if finished or len(rows) != n_batch:
+            # scatter the finished rows back, padded with EOT to the same length
+            for row, index in enumerate(rows):
+                if index >= 0:
+                    finished[index] = (tokens[row], sum_logprobs[row])
+            n_tokens = tokens.shape[1]
+            tokens = mx.stack(
+                [
+                    mx.pad(
+                        finished[index][0],
+                        (0, n_tokens - finished[index][0].shape[0]),
+                        constant_values=eot,
+                    )
+                    for index in range(n_batch)
+                ]
+            )
+            sum_logprobs = mx.stack([finished[index][1] for index in range(n_batch)])
 
-    def run(self, mel: mx.array) -> List[DecodingResult]:
-        self.decoder.reset()
-        tokenizer: Tokenizer = self.tokenizer
-        n_audio: int = mel.shape[0]
+        return tokens, sum_logprobs, no_speech_probs, looped
+
+    def _speculative_loop(
+        self,
+        audio_features: mx.array,
+        draft_features: mx.array,
+        tokens: mx.array,
+        no_speech_probs: List[float],
+        sample_lens: np.ndarray,
+    ):
+        """
+        Greedy decoding where the draft model proposes `options.draft_tokens`
+        tokens for every row and the model scores all of them in a single
+        forward pass. Each row accepts the proposals for as long as they match
+        the model's own choice, so the output is the same as the one of
+        `_main_loop`, and leaves the batch once it samples EOT or reaches its
+        entry of `sample_lens`.
+
+        Without a draft model, the proposals are the tokens that followed the
+        last n tokens of each row where they last appeared in the prompt or in
+        the text decoded so far, which is cheap and often right on repetitive
+        speech; a row without such a match proposes EOT, and `draft_features`
+        is unused.
+
+        The rows end at the same column: a row that accepted fewer tokens than
+        the others gets more padding on its left, as the rows with shorter
+        prompts do, and its cached columns are moved to the right to match.
+        """
+        n_batch = tokens.shape[0]
+        eot = self.tokenizer.eot
+        # no row samples past the text context, as in `_main_loop`
+        sample_lens = np.minimum(sample_lens, self.n_ctx + 1 - self.sample_begin)
+
+        # `rows` holds the original index of the rows that are still decoding,
+        # `sequences` the tokens of every row without its padding
+        rows = np.arange(n_batch)
+        initial_padding = np.zeros(n_batch, np.int64)
+        if self.inference.padding is not None:
+            initial_padding = np.array(self.inference.padding)
+        sequences = [
+            row[p:] for row, p in zip(np.array(tokens).tolist(), initial_padding)
+        ]
+        n_sampled = np.zeros(n_batch, np.int64)
+        sum_logprobs: mx.array = mx.zeros(n_batch)
+        final_logprobs = np.zeros(n_batch, np.float32)
 
-        mel = mx.repeat(mel, repeats=1, axis=0)
-        n_audio *= 1
+        try:
+            first = True
+            while True:
+                # propose draft tokens, without running past the sample length
+                # or the text context
+                n_tokens = tokens.shape[-1]
+                remaining = sample_lens[rows] - n_sampled
+                n_draft = min(
+                    self.options.draft_tokens,
+                    int(remaining.max()) - 1,
+                    self.n_ctx - n_tokens,
+                )
+                draft = tokens
+                if self.draft_model is not None:
+                    for _ in range(n_draft):
+                        logits = self.draft_inference.logits(draft, draft_features)
+                        next_tokens = logits[:, -1].argmax(axis=-1)
+                        draft = mx.concatenate([draft, next_tokens[:, None]], axis=-1)
+                elif n_draft > 0:
+                    matches = [
+                        lookup_ngram(
+                            np.array(sequences[row]),
+                            self.options.prompt_lookup,
+                            n_draft,
+                        )
+                        for row in rows
+                    ]
+                    n_draft = max(map(len, matches))
+                    if n_draft > 0:
+                        proposals = np.full((len(rows), n_draft), eot)
+                        for proposal, match in zip(proposals, matches):
+                            proposal[: len(match)] = match
+                        draft = mx.concatenate(
+                            [tokens, mx.array(proposals, tokens.dtype)], axis=-1
+                        )
+
+                # score the last token and the proposals at once
+                logits = self.inference.logits(draft, audio_features)
+                if first:
+                    no_speech_probs = self._no_speech_probs(
+                        logits[:, 0], no_speech_probs
+                    )
+                logits = logits[:, -(n_draft + 1) :]
+
+                # a row takes the tokens of the steps it is active in: all of
+                # the steps up to the first proposal it does not accept
+                last_tokens = tokens[:, -1]
+                active = mx.ones(len(rows), mx.bool_)
+                new_tokens, accepted = [], []
+                for i in range(n_draft + 1):
+                    step_logits = logits[:, i]
+                    for logit_filter in self.logit_filters:
+                        if first and i == 0:
+                            step_logits = logit_filter.apply(step_logits, tokens)
+                            continue
+                        state = logit_filter.get_state()
+                        step_logits, new_state = logit_filter.step(
+                            step_logits, last_tokens, state
+                        )
+                        logit_filter.set_state(new_state)
+                        logit_filter.restore_rows(~active, state)
+                    next_tokens, next_logprobs = self.decoder.select(
+                        step_logits, last_tokens, sum_logprobs
+                    )
+                    sum_logprobs = mx.where(active, next_logprobs, sum_logprobs)
+                    new_tokens.append(next_tokens)
+                    accepted.append(active)
+
+                    active = active & (next_tokens != eot)
+                    active = active & mx.array(i + 1 < remaining)
+                    if i < n_draft:
+                        active = active & (next_tokens == draft[:, n_tokens + i])
+                    last_tokens = next_tokens
+                first = False
+
+                new_tokens = np.array(mx.stack(new_tokens, axis=1))
+                n_accepted = np.array(mx.stack(accepted, axis=1)).sum(axis=1)
+                logprobs = np.array(sum_logprobs)
+                done = np.zeros(len(rows), bool)
+                for i, row in enumerate(rows):
+                    sequences[row] += new_tokens[i, : n_accepted[i]].tolist()
+                    done[i] = sequences[row][-1] == eot
+                n_sampled += n_accepted
+                done |= n_sampled >= sample_lens[rows]
+                final_logprobs[rows[done]] = logprobs[done]
+
+                keep = np.flatnonzero(~done)
+                if len(keep) == 0:
+                    break
+                rows, n_sampled = rows[keep], n_sampled[keep]
+                lengths = np.array([len(sequences[row]) for row in rows])
+                n_tokens = int(lengths.max())
+                padding = n_tokens - lengths
+
+                # the caches keep the accepted tokens, all but the newest one
+                self.inference.realign(keep, padding, n_tokens - 1)
+                if self.draft_model is not None:
+                    self.draft_inference.realign(keep, padding, n_tokens - 1)
+                index = mx.array(keep)
+                for logit_filter in self.logit_filters:
+                    logit_filter.rearrange(index)
+                sum_logprobs = sum_logprobs[index]
+                audio_features = audio_features[index]
+                if draft_features is not None:
+                    draft_features = draft_features[index]
+                tokens = mx.array(
+                    [[eot] * p + sequences[row] for p, row in zip(padding, rows)],
+                    tokens.dtype,
+                )
+        finally:
+            self.inference.reset()
+            if self.draft_model is not None:
+                self.draft_inference.reset()
+
+        # back to the rows of the initial tokens, padded with EOT on the right
+        sequences = [[eot] * p + s for p, s in zip(initial_padding, sequences)]
+        n_tokens = max(map(len, sequences))
+        tokens = mx.array([s + [eot] * (n_tokens - len(s)) for s in sequences])
+        return tokens, mx.array(final_logprobs), no_speech_probs
+
+    def prefill(self, mel: mx.array) -> Prefill:
+        """
+        Encode the audio, detect the language if requested and run the decoder
+        over the initial tokens set by `prepare`, all but the last one
+        """
+        n_audio: int = mel.shape[0]
 
         audio_features: mx.array = self._get_audio_features(mel)  # encoder forward pass
-        tokens: np.array = np.array(self.initial_tokens)
-        tokens = np.broadcast_to(tokens, (n_audio, len(self.initial_tokens))).copy()
+        if len(self.initial_tokens) not in (1, n_audio):
+            raise ValueError(
+                f"got {len(self.initial_tokens)} prompts for {n_audio} audio inputs"
+            )
+        tokens: np.array = np.broadcast_to(
+            self.initial_tokens, (n_audio, self.sample_begin)
+        ).copy()
+        padding = np.broadcast_to(self.padding, n_audio)
+        sot_index = np.broadcast_to(self.sot_index, n_audio)
 
         # detect language if requested, overwriting the language token
         languages, language_probs = self._detect_language(audio_features, tokens)
+        tokens = mx.array(tokens)
+
+        no_speech_probs = [np.nan] * n_audio
+        n_layer = len(self.model.decoder.blocks)
+        kv_cache, cross_kv = [None] * n_layer, [None] * n_layer
+        inference = Inference(
+            self.model, self.options.kv_bits, self.options.kv_group_size
+        )
+        if self.options.task != "lang_id":
+            # projected once for the whole decoding, fallbacks included
+            cross_kv = inference.cross_kv(audio_features)
+        if self.sample_begin > 1 and self.options.task != "lang_id":
+            inference.kv_cache = [(inference.new_cache(), kv) for kv in cross_kv]
+            if padding.any():
+                inference.padding = mx.array(padding)
+            # only the logits at startoftranscript are used, for no_speech_probs
+            index = np.minimum(sot_index, self.sample_begin - 2)
+            logits = inference.logits(
+                tokens[:, :-1], audio_features, logit_positions=mx.array(index)[:, None]
+            )
+            kv_cache = [
+                tree_map(lambda x: x[:, : kv.offset], (kv.keys, kv.values))
+                for kv, _ in inference.kv_cache
+            ]
+
+            # the rows whose last initial token is startoftranscript get their
+            # no-speech probability from the first decoding step
+            if self.tokenizer.no_speech is not None:
+                in_prefill = sot_index < self.sample_begin - 1
+                probs_at_sot = mx.softmax(logits[:, 0], axis=-1)
+                probs = probs_at_sot[:, self.tokenizer.no_speech].tolist()
+                no_speech_probs = np.where(in_prefill, probs, np.nan).tolist()
+
+        return Prefill(
+            audio_features=audio_features,
+            tokens=tokens,
+            padding=padding,
+            languages=languages,
+            language_probs=language_probs,
+            no_speech_probs=no_speech_probs,
+            kv_cache=kv_cache,
+            cross_kv=cross_kv,
+        )
+
+    def run(
+        self,
+        mel: mx.array,
+        prefill: Optional[Prefill] = None,
+        durations: Optional[Sequence[float]] = None,
+    ) -> List[DecodingResult]:
+        """
+        Decode a batch of audio; `prefill`, when given, comes from `prefill()`
+        of a task with the same model, audio and initial tokens. `durations`,
+        the seconds of audio in each window, lower the number of tokens sampled
+        for the short ones according to `options.max_tokens_per_second`
+        """
+        self.decoder.reset()
+        tokenizer: Tokenizer = self.tokenizer
+
+        if prefill is None:
+            prefill = self.prefill(mel)
+        if prefill.tokens.shape[1] != self.sample_begin:
+            raise ValueError("the prefill was made for other initial tokens")
+        n_audio: int = prefill.tokens.shape[0]
+        audio_features = prefill.audio_features
+        languages, language_probs = prefill.languages, prefill.language_probs
         if self.options.task == "lang_id":
             return [
                 DecodingResult(
@@ -629,32 +1919,62 @@ class DecodingTask:
                 )
             ]
 
-        # repeat tokens by the group size, for beam search or best-of-n sampling
-        tokens = mx.array(tokens)
+        # repeat text tensors by the group size, for beam search or best-of-n
+        # sampling; the samples of an audio start from the same prefill
+        tokens = prefill.tokens
+        no_speech_probs = prefill.no_speech_probs
         if self.n_group > 1:
-            tokens = tokens[:, None, :]
-            tokens = mx.broadcast_to(
-                tokens, [n_audio, self.n_group, len(self.initial_tokens)]
-            )
-            tokens = tokens.reshape(
-                tokens, (n_audio * self.n_group, len(self.initial_tokens))
-            )
+            tokens = mx.repeat(tokens, self.n_group, axis=0)
+            audio_features = mx.repeat(audio_features, self.n_group, axis=0)
+            no_speech_probs = np.repeat(no_speech_probs, self.n_group).tolist()
+        self.inference.load(prefill, self.n_group)
+
+        # positions and attention masks for the rows with left padding
+        if prefill.padding.any():
+            padding = mx.array(np.repeat(prefill.padding, self.n_group))
+            self.inference.padding = padding
+            if self.draft_model is not None:
+                self.draft_inference.padding = padding
 
         # call the main sampling loop
-        tokens, sum_logprobs, no_speech_probs = self._main_loop(audio_features, tokens)
+        looped = np.zeros(tokens.shape[0], dtype=bool)
+        sample_lens = np.repeat(self._sample_lens(durations, n_audio), self.n_group)
+        if self.draft_model is not None:
+            draft_features = self._get_draft_audio_features(mel, audio_features)
+            tokens, sum_logprobs, no_speech_probs = self._speculative_loop(
+                audio_features,
+                draft_features,
+                tokens,
+                no_speech_probs,
+                sample_lens,
+            )
+        elif self.options.prompt_lookup is not None:
+            tokens, sum_logprobs, no_speech_probs = self._speculative_loop(
+                audio_features, None, tokens, no_speech_probs, sample_lens
+            )
+        else:
+            tokens, sum_logprobs, no_speech_probs, looped = self._main_loop(
+                audio_features, tokens, no_speech_probs, sample_lens
+            )
 
         # reshape the tensors to have (n_audio, n_group) as the first two dimensions
         audio_features = audio_features[:: self.n_group]
-        no_speech_probs = no_speech_probs[:: self.n_group]
+        no_speech_probs = np.array(no_speech_probs)[:: self.n_group].tolist()
         assert audio_features.shape[0] == len(no_speech_probs) == n_audio
 
         tokens = tokens.reshape(n_audio, self.n_group, -1)
         sum_logprobs = sum_logprobs.reshape(n_audio, self.n_group)
+        looped = looped.reshape(n_audio, self.n_group)
 
         # get the final candidates for each group, and slice between the first sampled token and EOT
         tokens, sum_logprobs = self.decoder.finalize(tokens, sum_logprobs)
-        tokens = tokens[..., self.sample_begin :].tolist()
-        tokens = [[t[: t.index(tokenizer.eot)] for t in s] for s in tokens]
+        tokens: List[List[List[int]]] = [
+            [
+                t[self.sample_begin : t.index(tokenizer.eot, self.sample_begin)]
+                for t in s
+            ]
+            for s in tokens
+        ]
 
         # select the top-ranked sample in each group
         selected = self.sequence_ranker.rank(tokens, sum_logprobs)
@@ -662,6 +1982,7 @@ class DecodingTask:
         texts: List[str] = [tokenizer.decode(t).strip() for t in tokens]
 
         sum_logprobs: List[float] = [lp[i] for i, lp in zip(selected, sum_logprobs)]
+        looped: List[bool] = [bool(row[i]) for i, row in zip(selected, looped)]
         avg_logprobs: List[float] = [
             lp / (len(t) + 1) for t, lp in zip(tokens, sum_logprobs)
         ]
@@ -673,6 +1994,7 @@ class DecodingTask:
             audio_features,
             avg_logprobs,
             no_speech_probs,
+            looped,
         )
         if len(set(map(len, fields))) != 1:
             raise RuntimeError(f"inconsistent result lengths: {list(map(len, fields))}")
@@ -687,17 +2009,105 @@ class DecodingTask:
                 no_speech_prob=no_speech_prob,
                 temperature=self.options.temperature,
                 compression_ratio=compression_ratio(text),
+                looped=looped,
             )
-            for text, language, tokens, features, avg_logprob, no_speech_prob in zip(
-                *fields
-            )
+            for (
+                text,
+                language,
+                tokens,
+                features,
+                avg_logprob,
+                no_speech_prob,
+                looped,
+            ) in zip(*fields)
         ]
 
 
+class DecodingSession:
+    """
+    Decodes many batches, of one file or of many, with the same model and
+    options. A `DecodingTask` -- the tokenizer, the decoder and the logit filters
+    with their masks -- is built once per temperature and reused by every call,
+    which only sets up the initial tokens for its prompt.
+
+    As in `transcribe`, `beam_size` and `patience` only apply at T=0 and
+    `best_of` only at T>0; `prompt_lookup` only applies to greedy passes.
+    """
+
+    model = None
+    sessions = {}
+
+    def __init__(self, model: "Whisper", options: DecodingOptions):
+        self.model = model
+        self.options = options
+        self.tasks: Dict[float, DecodingTask] = {}
+
+    @classmethod
+    def get(cls, model: "Whisper", options: DecodingOptions) -> "DecodingSession":
+        """The session for the model and options, kept for the most recent model"""
+        if cls.model is not model:
+            cls.model = model
+            cls.sessions = {}
+        key = tuple(
+            tuple(value) if isinstance(value, list) else value
+            for value in astuple(replace(options, prompt=None, temperature=0.0))
+        )
+        if key not in cls.sessions:
+            cls.sessions[key] = cls(model, options)
+        return cls.sessions[key]
+
+    def task(self, temperature: float) -> DecodingTask:
+        if temperature not in self.tasks:
+            options = replace(self.options, temperature=temperature)
+            if temperature > 0:
+                options = replace(
+                    options, beam_size=None, patience=None, prompt_lookup=None
+                )
+            else:
+                options = replace(options, best_of=None)
+                if options.beam_size is not None:
+                    options = replace(options, prompt_lookup=None)
+            self.tasks[temperature] = DecodingTask(self.model, options)
+        return self.tasks[temperature]
+
+    def decode(
+        self,
+        mel: mx.array,
+        prompt: Optional[Union[str, List[int], List[Union[str, List[int]]]]] = None,
+        temperature: Optional[float] = None,
+        draft_model: Optional["Whisper"] = None,
+        prefill: Optional[Prefill] = None,
+        durations: Optional[Sequence[float]] = None,
+    ) -> List[DecodingResult]:
+        """
+        Decode a batch of Mel spectrograms, shape = (*, 3000, n_mels), with
+        `prompt` and `temperature` replacing the ones of the session's options;
+        `prompt` may be a list with one prompt for each spectrogram. `prefill`,
+        from `prefill()` with the same spectrograms and prompt, saves running
+        them through the model again; `durations` are as in `DecodingTask.run`
+        """
+        if temperature is None:
+            temperature = self.options.temperature
+        task = self.task(temperature)
+        task.prepare(prompt, draft_model)
+        return task.run(mel, prefill, durations)
+
+    def prefill(
+        self,
+        mel: mx.array,
+        prompt: Optional[Union[str, List[int], List[Union[str, List[int]]]]] = None,
+    ) -> Prefill:
+        """The decoder state after the prompt, for `decode` at any temperature"""
+        task = self.task(self.options.temperature)
+        task.prepare(prompt)
+        return task.prefill(mel)
+
+
 def decode(
     model: "Whisper",
     mel: mx.array,
     options: DecodingOptions = DecodingOptions(),
+    draft_model: Optional["Whisper"] = None,
     **kwargs,
 ) -> Union[DecodingResult, List[DecodingResult]]:
     """
@@ -714,6 +2124,10 @@ def decode(
     options: DecodingOptions
         A dataclass that contains all necessary options for decoding 30-second segments
 
+    draft_model: Whisper, optional
+        A smaller model with the same vocabulary, e.g. a distil-whisper checkpoint, which
+        proposes `options.draft_tokens` tokens at a time for greedy speculative decoding
+
     Returns
     -------
     result: Union[DecodingResult, List[DecodingResult]]
@@ -725,5 +2139,5 @@ def decode(
     if kwargs:
         options = replace(options, **kwargs)
 
-    result = DecodingTask(model, options).run(mel)
+    result = DecodingTask(model, options, draft_model).run(mel)
     return result[0] if single else result
@@ -52,15 +52,19 @@ models = {
 }
 
 class LightningWhisperMLX():
-    def __init__(self, model, batch_size = 12, quant=None):
+    def __init__(self, model, batch_size = 12, quant=None, kv_bits=None):
         if quant and (quant != "4bit" and quant !="8bit"):
             raise ValueError("Quantization must be `4bit` or `8bit`")
+
+        if kv_bits not in (None, 4, 8):
+            raise ValueError("KV cache quantization must be 4 or 8 bits")
         
         if model not in models: 
             raise ValueError("Please select a valid model")
         
         self.name = model
         self.batch_size = batch_size
+        self.kv_bits = kv_bits
 
         repo_id = ""
 
@@ -87,6 +91,6 @@ class LightningWhisperMLX():
         hf_hub_download(repo_id=repo_id, filename=filename1, local_dir=local_dir)
         hf_hub_download(repo_id=repo_id, filename=filename2, local_dir=local_dir)
     
-    def transcribe(self, audio_path, language=None):
-        result = transcribe_audio(audio_path, path_or_hf_repo=f'./mlx_models/{self.name}', language=language, batch_size=self.batch_size)
+    def transcribe(self, audio_path, language=None, language_per_window=False, timestamps="segment"):
+        result = transcribe_audio(audio_path, path_or_hf_repo=f'./mlx_models/{self.name}', language=language, batch_size=self.batch_size, kv_bits=self.kv_bits, language_per_window=language_per_window, timestamps=timestamps)
         return result
\ No newline at end of file
@@ -0,0 +1,424 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+import mlx.core as mx
+import numpy as np
+from mlx.utils import tree_map
+
+from .decoding import (
+    BlockAllocator,
+    DecodingOptions,
+    DecodingResult,
+    DecodingTask,
+    KVCache,
+    PagedKVCache,
+    compression_ratio,
+    kv_arrays,
+    quantize_kv,
+)
+
+
+@dataclass
+class SchedulerStats:
+    batch_size: int
+    n_steps: int = 0  # batched decoder forward passes
+    n_active: int = 0  # summed over the steps: slots that held a window
+    n_admitted: int = 0
+    n_retired: int = 0
+    n_preempted: int = 0  # windows put back to be decoded again, see `n_blocks`
+
+    @property
+    def occupancy(self) -> float:
+        """Fraction of the batch slots that did useful work, over all steps"""
+        return self.n_active / max(self.n_steps * self.batch_size, 1)
+
+
+class DecodingScheduler:
+    """
+    Decodes a stream of 30-second windows with a fixed number of batch slots.
+    A window leaves its slot as soon as it samples EOT or runs out of tokens,
+    and the next window is admitted into the free slot on the following step,
+    so the batch keeps decoding instead of waiting for its longest row.
+
+    The rows share one token array, aligned by column: a row occupies the
+    columns from its `start` to the current end and is fed positions relative
+    to that start. A window admitted later has its prompt prefilled separately
+    and placed right before the current end.
+
+    The self-attention keys and values are kept in a `PagedKVCache`, in blocks
+    of `block_size` columns from a pool of `n_blocks` that a row takes from as
+    it grows and returns when it is retired. By default, the pool holds the
+    whole text context of every slot. A smaller pool fits more slots in the
+    same memory, since most windows stop well before the end of the context;
+    when it runs short, the most recently admitted window gives its blocks
+    back and is decoded again from the start once there is room.
+
+    Beam search and best-of-n sampling are not supported.
+    """
+
+    def __init__(
+        self,
+        model: "Whisper",
+        options: DecodingOptions,
+        batch_size: int,
+        n_blocks: Optional[int] = None,
+        block_size: int = 16,
+    ):
+        self.model = model
+        self.task = DecodingTask(model, options)
+        if self.task.n_group > 1:
+            raise ValueError(
+                "beam search and best-of-n sampling are not supported with "
+                "continuous batching"
+            )
+        self.batch_size = batch_size
+        self.block_size = block_size
+        # block 0 is reserved, see `BlockAllocator`
+        blocks_per_row = -(-model.dims.n_text_ctx // block_size)
+        self.n_blocks = n_blocks or batch_size * blocks_per_row + 1
+        if self.n_blocks - 1 < blocks_per_row:
+            raise ValueError(
+                f"n_blocks should be more than {blocks_per_row}, enough for one "
+                "window to fill the text context"
+            )
+        self.stats = SchedulerStats(batch_size)
+
+    def run(
+        self, windows: Iterable[Tuple[mx.array, Optional[Union[str, List[int]]]]]
+    ) -> Iterator[Tuple[int, DecodingResult]]:
+        """
+        Decode `(mel, prompt)` windows, where mel has the shape (3000, n_mels)
+        and prompt overrides `options.prompt`. The windows are taken from the
+        iterable only when a slot is free, and `(index, result)` pairs are
+        yielded in the order the windows finish.
+
+        A window may also be `(mel, prompt, duration)`, with the seconds of
+        audio it holds, to sample fewer tokens for a short window according to
+        `options.max_tokens_per_second`.
+        """
+        task, model = self.task, self.model
+        tokenizer = task.tokenizer
+        eot = tokenizer.eot
+        n_batch, n_ctx = self.batch_size, task.n_ctx
+        dtype = mx.float16 if task.options.fp16 else mx.float32
+        dims = model.dims
+        bits, group_size = task.options.kv_bits, task.options.kv_group_size
+
+        # column-aligned state; an empty slot only sees its own newest column
+        tokens = mx.full((n_batch, 1), eot)
+        sum_logprobs = mx.zeros(n_batch)
+        audio_features = mx.zeros(
+            (n_batch, dims.n_audio_ctx, dims.n_audio_state), dtype
+        )
+        allocator = BlockAllocator(n_batch, self.n_blocks, self.block_size)
+        kv_cache = []
+        for block in model.decoder.blocks:
+            # the caches are written in place, each needs its own arrays
+            kv = PagedKVCache(allocator, dims.n_text_state, dtype, bits, group_size)
+            cross_kv = (
+                quantize_kv(mx.zeros_like(audio_features), bits, group_size),
+                quantize_kv(mx.zeros_like(audio_features), bits, group_size),
+            )
+            kv_cache.append((kv, cross_kv))
+
+        window_index = np.full(n_batch, -1)
+        admitted = np.zeros(n_batch, np.int64)  # the admission order of the rows
+        prompts = [None] * n_batch
+        durations = [None] * n_batch
+        sample_lens = np.zeros(n_batch, np.int64)
+        start = np.zeros(n_batch, np.int64)
+        sample_begin = np.full(n_batch, -1)
+        no_speech_probs = [np.nan] * n_batch
+        languages = [task.options.language] * n_batch
+        language_probs = [None] * n_batch
+
+        windows = iter(windows)
+        # preempted windows, with their audio features, to be decoded again
+        requeued = deque()
+        exhausted = False
+        n_windows = 0
+        n_admissions = 0
+        while True:
+            free = np.flatnonzero(window_index < 0)
+            cohort, indices = [], []
+            n_free_blocks = len(allocator.free)
+            while len(cohort) < len(free):
+                if requeued:
+                    index, window = requeued.popleft()
+                elif not exhausted:
+                    window = next(windows, None)
+                    if window is None:
+                        exhausted = True
+                        break
+                    index, n_windows = n_windows, n_windows + 1
+                else:
+                    break
+                # admit a window only once its prompt fits in the free blocks
+                n_prompt = len(task._get_initial_tokens(window[1]))
+                n_free_blocks -= -(-n_prompt // self.block_size)
+                if n_free_blocks < 0:
+                    requeued.appendleft((index, window))
+                    break
+                cohort.append(window)
+                indices.append(index)
+            if cohort:
+                rows = free[: len(cohort)]
+                window_index[rows] = indices
+                admitted[rows] = np.arange(n_admissions, n_admissions + len(cohort))
+                n_admissions += len(cohort)
+                for row, window in zip(rows, cohort):
+                    prompts[row] = window[1]
+                    durations[row] = window[2] if len(window) > 2 else None
+                    sample_lens[row] = task._sample_lens(
+                        None if durations[row] is None else [durations[row]], 1
+                    )[0]
+                tokens, start, sample_begin = self._admit(
+                    cohort,
+                    rows,
+                    tokens,
+                    audio_features,
+                    kv_cache,
+                    allocator,
+                    start,
+                    sample_begin,
+                    no_speech_probs,
+                    languages,
+                    language_probs,
+                )
+                sum_logprobs[mx.array(rows)] = 0.0
+
+            active = window_index >= 0
+            if not active.any():
+                break
+
+            # every row needs a column for its newest token; the newest rows give
+            # their blocks back when the pool is short
+            for row in np.flatnonzero(active)[np.argsort(admitted[active])]:
+                while window_index[row] >= 0 and not allocator.allocate(
+                    row, allocator.lengths[row] + 1
+                ):
+                    newest = np.flatnonzero(window_index >= 0)
+                    newest = newest[np.argmax(admitted[newest])]
+                    window = (
+                        audio_features[int(newest)],
+                        prompts[newest],
+                        durations[newest],
+                    )
+                    requeued.appendleft((int(window_index[newest]), window))
+                    allocator.release(newest)
+                    window_index[newest] = -1
+                    sample_begin[newest] = -1
+                    tokens[int(newest), -1] = eot
+                    self.stats.n_preempted += 1
+            active = window_index >= 0
+
+            # make room at the end of the context by dropping the columns that
+            # are before the start of every row
+            if tokens.shape[1] > n_ctx:
+                shift = int(np.where(active, start, tokens.shape[1] - 1).min())
+                tokens = tokens[:, shift:]
+                start, sample_begin = start - shift, sample_begin - shift
+
+            # empty slots only attend to their newest column
+            n_tokens = tokens.shape[1]
+            start = np.where(active, start, n_tokens - 1)
+            positions = mx.array(n_tokens - 1 - start)[:, None]
+            allocator.prepare(np.flatnonzero(active))
+            columns = np.arange(allocator.table.shape[1] * self.block_size)
+            padding_mask = mx.array(columns[None] <= allocator.lengths[:, None])
+            logits, _, _ = model.decoder(
+                tokens[:, -1:],
+                audio_features,
+                kv_cache=kv_cache,
+                positions=positions,
+                padding_mask=padding_mask,
+            )
+            logits = logits[:, -1].astype(mx.float32)
+            allocator.lengths[active] += 1
+
+            # rows whose last prompt token is the startoftranscript token
+            at_sot = [b for b in np.flatnonzero(active) if np.isnan(no_speech_probs[b])]
+            if at_sot and tokenizer.no_speech is not None:
+                probs = mx.softmax(logits[mx.array(at_sot)], axis=-1)
+                for b, p in zip(at_sot, probs[:, tokenizer.no_speech].tolist()):
+                    no_speech_probs[b] = p
+
+            sample_begin_array = mx.array(sample_begin)
+            for logit_filter in task.logit_filters:
+                logit_filter.sample_begin = sample_begin_array
+                logits = logit_filter.apply(logits, tokens)
+
+            tokens, _, sum_logprobs = task.decoder.update(tokens, logits, sum_logprobs)
+
+            self.stats.n_steps += 1
+            self.stats.n_active += int(active.sum())
+
+            # retire the rows that sampled EOT, ran out of samples or context
+            n_tokens = tokens.shape[1]
+            last = np.array(tokens[:, -1])
+            finished = active & (
+                (last == eot)
+                | (n_tokens - sample_begin >= sample_lens)
+                | (n_tokens - start > n_ctx)
+            )
+            if not finished.any():
+                continue
+
+            rows = np.flatnonzero(finished)
+            finished_tokens = np.array(tokens[mx.array(rows)])
+            finished_logprobs = np.array(sum_logprobs[mx.array(rows)])
+            for row, row_tokens, sum_logprob in zip(
+                rows, finished_tokens, finished_logprobs
+            ):
+                row_tokens = row_tokens[sample_begin[row] :].tolist()
+                if eot in row_tokens:
+                    row_tokens = row_tokens[: row_tokens.index(eot)]
+                text = tokenizer.decode(row_tokens).strip()
+                result = DecodingResult(
+                    audio_features=audio_features[int(row)],
+                    language=languages[row],
+                    language_probs=language_probs[row],
+                    tokens=row_tokens,
+                    text=text,
+                    avg_logprob=float(sum_logprob) / (len(row_tokens) + 1),
+                    no_speech_prob=no_speech_probs[row],
+                    temperature=task.options.temperature,
+                    compression_ratio=compression_ratio(text),
+                )
+                index = int(window_index[row])
+                window_index[row] = -1
+                sample_begin[row] = -1
+                allocator.release(row)
+                self.stats.n_retired += 1
+                yield index, result
+
+            # a retired row may still hold a token other than EOT in its
+            # newest column; the slot keeps feeding EOT until it is reused
+            tokens[mx.array(rows), -1] = eot
+
+    def _admit(
+        self,
+        cohort,
+        rows,
+        tokens,
+        audio_features,
+        kv_cache,
+        allocator,
+        start,
+        sample_begin,
+        no_speech_probs,
+        languages,
+        language_probs,
+    ):
+        """
+        Encode the windows of `cohort`, prefill their prompts and move them into
+        the free slots `rows`, right-aligned with the current end of `tokens`.
+        """
+        task, model = self.task, self.model
+        tokenizer = task.tokenizer
+        n_ctx = task.n_ctx
+
+        # windows may come already encoded, the others share one encoder pass
+        dims = model.dims
+        features = [window[0] for window in cohort]
+        encoded = [
+            f.shape[-2:] == (dims.n_audio_ctx, dims.n_audio_state) for f in features
+        ]
+        if not all(encoded):
+            mel = mx.stack([f for f, e in zip(features, encoded) if not e])
+            new_features = iter(task._get_audio_features(mel))
+            features = [
+                f if e else next(new_features) for f, e in zip(features, encoded)
+            ]
+        features = task._get_audio_features(mx.stack(features))
+        initial_tokens = [list(task._get_initial_tokens(w[1])) for w in cohort]
+        sot_index = [t.index(tokenizer.sot) for t in initial_tokens]
+
+        new_languages = [task.options.language] * len(cohort)
+        new_language_probs = [None] * len(cohort)
+        if task.options.language is None:
+            lang_tokens, new_language_probs = model.detect_language(features, tokenizer)
+            new_languages = [max(p, key=p.get) for p in new_language_probs]
+            for t, i, lang_token in zip(
+                initial_tokens, sot_index, lang_tokens.tolist()
+            ):
+                t[i + 1] = lang_token
+
+        # the prompts are left-padded to the longest one; the last prompt token
+        # is fed by the next decoding step, together with the other rows
+        n_prompt = max(map(len, initial_tokens))
+        padding = np.array([n_prompt - len(t) for t in initial_tokens])
+        prompt = mx.array(
+            [[tokenizer.eot] * p + t for p, t in zip(padding, initial_tokens)]
+        )
+
+        # make room for the longest prompt before the current end
+        shift = n_prompt - tokens.shape[1]
+        if shift > 0:
+            tokens = mx.pad(tokens, [(0, 0), (shift, 0)], constant_values=tokenizer.eot)
+            start, sample_begin = start + shift, sample_begin + shift
+        n_tokens = tokens.shape[1]
+
+        bits, group_size = task.options.kv_bits, task.options.kv_group_size
+        cross_kv = task.inference.cross_kv(features)
+        index = mx.array(rows)
+        audio_features[index] = features
+        for (_, cache), new in zip(kv_cache, cross_kv):
+            for x, y in zip(
+                kv_arrays(cache[0]) + kv_arrays(cache[1]),
+                kv_arrays(new[0]) + kv_arrays(new[1]),
+            ):
+                x[index] = y
+
+        logits = None
+        if n_prompt > 1:
+            columns = np.arange(n_prompt - 1)
+            positions = mx.array(np.maximum(columns[None] - padding[:, None], 0))
+            padding_mask = mx.array(columns[None] >= padding[:, None])
+            prefill_cache = [(KVCache(n_ctx, bits, group_size), c) for c in cross_kv]
+            # only the logits at startoftranscript are used, for no_speech_probs
+            sot_column = np.minimum(padding + np.array(sot_index), n_prompt - 2)
+            logits, _, _ = model.decoder(
+                prompt[:, :-1],
+                features,
+                kv_cache=prefill_cache,
+                positions=positions,
+                padding_mask=padding_mask,
+                logit_positions=mx.array(sot_column)[:, None],
+            )
+
+        # the blocks of the rows hold their own prompt columns only
+        for j, row in enumerate(rows):
+            n_cached = len(initial_tokens[j]) - 1
+            allocator.lengths[row] = n_cached
+            if n_cached == 0:
+                continue
+            allocator.allocate(row, n_cached)
+            for (kv, _), (new_kv, _) in zip(kv_cache, prefill_cache):
+                kv.fill(
+                    row,
+                    *tree_map(
+                        lambda x: x[j, int(padding[j]) : n_prompt - 1],
+                        (new_kv.keys, new_kv.values),
+                    ),
+                )
+
+        tokens[index, n_tokens - n_prompt :] = prompt
+        start[rows] = n_tokens - n_prompt + padding
+        sample_begin[rows] = n_tokens
+
+        for j, row in enumerate(rows):
+            languages[row] = new_languages[j]
+            language_probs[row] = new_language_probs[j]
+            no_speech_probs[row] = np.nan
+            # when the startoftranscript token is part of the prefill, its
+            # logits are already there; otherwise the next step computes them
+            if sot_index[j] < len(initial_tokens[j]) - 1:
+                if tokenizer.no_speech is None:
+                    continue
+                probs = mx.softmax(logits[j, 0].astype(mx.float32))
+                no_speech_probs[row] = probs[tokenizer.no_speech].item()
+
+        self.stats.n_admitted += len(cohort)
+        return tokens, start, sample_begin
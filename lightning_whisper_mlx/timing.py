@@ -131,7 +131,11 @@ def find_alignment(
         ]
     )
 
-    logits, cross_qk = model.forward_with_cross_qk(mel[None, :], tokens[None, :])
+    # `mel` may also be the audio features of the window, as kept in the
+    # `DecodingResult`, which saves an encoder forward pass
+    logits, weights = model.forward_with_alignment_qk(
+        mel[None, :], tokens[None, :], num_frames // 2
+    )
     # consider only the logits associated with predicting text
     sampled_logits = logits[0][len(tokenizer.sot_sequence) : -2, : tokenizer.eot]
     token_probs = mx.softmax(sampled_logits.astype(mx.float32), axis=-1).astype(
@@ -143,11 +147,7 @@ def find_alignment(
     text_token_probs = np.array(text_token_probs)
 
     # heads * tokens * frames
-    weights = mx.stack(
-        [cross_qk[_l.item()][0, _h.item()] for _l, _h in model.alignment_heads]
-    )
-    weights = weights[:, :, : num_frames // 2]
-    weights = mx.softmax(weights * qk_scale, axis=-1)
+    weights = mx.softmax(weights[0] * qk_scale, axis=-1)
     mean = mx.mean(weights, axis=-2, keepdims=True)
     std = mx.var(weights, axis=-2, keepdims=True, ddof=0).sqrt()
     weights = (weights - mean) / std
@@ -18,8 +18,9 @@ from .audio import (
     log_mel_spectrogram,
     pad_or_trim,
 )
-from .decoding import DecodingOptions, DecodingResult
+from .decoding import DecodingOptions, DecodingResult, DecodingSession
 from .load_models import load_model
+from .scheduler import DecodingScheduler
 from .timing import add_word_timestamps
 from .tokenizer import LANGUAGES, get_tokenizer
 
@@ -50,16 +51,21 @@ def _get_end(segments: List[dict]) -> Optional[float]:
 
 class ModelHolder:
     model = None
-    model_path = None
+    model_key = None
 
     @classmethod
     def get_model(cls, model_path: str, dtype: mx.Dtype):
-        if cls.model is None or model_path != cls.model_path:
+        if cls.model is None or (model_path, dtype) != cls.model_key:
             cls.model = load_model(model_path, dtype=dtype)
-            cls.model_path = model_path
+            cls.model_key = (model_path, dtype)
         return cls.model
 
 
+class DraftModelHolder(ModelHolder):
+    model = None
+    model_key = None
+
+
 def transcribe_audio(
     audio: Union[str, np.ndarray, mx.array],
     *,
@@ -77,6 +83,10 @@ def transcribe_audio(
     clip_timestamps: Union[str, List[float]] = "0",
     hallucination_silence_threshold: Optional[float] = None,
     batch_size: 6,
+    continuous_batching: bool = False,
+    draft_path_or_hf_repo: Optional[str] = None,
+    language_per_window: bool = False,
+    timestamps: str = "segment",
     **decode_options,
 ):
     """
@@ -139,19 +149,80 @@ def transcribe_audio(
         When word_timestamps is True, skip silent periods longer than this threshold (in seconds)
         when a possible hallucination is detected
 
+    batch_size: int
+        Number of 30-second windows decoded together
+
+    continuous_batching: bool
+        Decode the windows with a `DecodingScheduler`, which admits the next window into the batch
+        as soon as one finishes instead of waiting for the whole batch. Beam search and best-of-n
+        sampling are not supported in this mode, nor is `prompt_lookup` speculative decoding.
+
+    draft_path_or_hf_repo: Optional[str]
+        A smaller model with the same vocabulary, e.g. a distil-whisper checkpoint, used as the
+        draft model for speculative decoding of the greedy (T=0) passes
+
+    language_per_window: bool
+        When the language is not given, detect it for every window from the window's own audio
+        features, as part of its batch, and decode each window with its own language token,
+        instead of detecting it once on the first 30 seconds; for code-switched audio
+
+    timestamps: str
+        "segment" to sample the timestamp tokens and split each window into segments, or "none"
+        to sample text tokens only, after <|notimestamps|>, with one segment per window and the
+        windows following each other at a fixed stride; faster when only the text is needed
+
     Returns
     -------
-    A dictionary containing the resulting text ("text") and segment-level details ("segments"), and
-    the spoken language ("language"), which is detected when `decode_options["language"]` is None.
+    A dictionary containing the resulting text ("text"), the segment-level details ("segments") as
+    [start_seek, end_seek, text, language] lists, and the spoken language ("language"), which is
+    detected when `decode_options["language"]` is None, or is the most common language of the
+    windows with `language_per_window`.
     """
 
+    if timestamps not in ("segment", "none"):
+        raise ValueError(f"timestamps should be 'segment' or 'none', got {timestamps!r}")
+    if timestamps == "none":
+        if word_timestamps:
+            raise ValueError("word_timestamps requires timestamps='segment'")
+        decode_options["without_timestamps"] = True
+
     dtype = mx.float16 if decode_options.get("fp16", True) else mx.float32
     model = ModelHolder.get_model(path_or_hf_repo, dtype)
+    draft_model = None
+    if draft_path_or_hf_repo is not None:
+        draft_model = DraftModelHolder.get_model(draft_path_or_hf_repo, dtype)
+
+    # the audio features of a window are computed once and shared by the
+    # language detection, the decoding passes and the temperature fallbacks,
+    # unless the draft model has an encoder of its own and needs the mel
+    encode_once = draft_model is None or (
+        draft_model.dims.n_audio_ctx,
+        draft_model.dims.n_audio_state,
+    ) == (model.dims.n_audio_ctx, model.dims.n_audio_state)
+    first_window_features = first_window = None
 
     # Pad 30-seconds of silence to the input audio, for slicing
     mel = log_mel_spectrogram(audio, n_mels=model.dims.n_mels, padding=N_SAMPLES)
     content_frames = mel.shape[-2] - N_FRAMES
 
+    if isinstance(clip_timestamps, str):
+        clip_timestamps = [
+            float(ts) for ts in (clip_timestamps.split(",") if clip_timestamps else [])
+        ]
+    seek_points: List[int] = [round(ts * FRAMES_PER_SECOND) for ts in clip_timestamps]
+    if len(seek_points) == 0:
+        seek_points.append(0)
+    if len(seek_points) % 2 == 1:
+        seek_points.append(content_frames)
+    seek_clips: List[Tuple[int, int]] = list(zip(seek_points[::2], seek_points[1::2]))
+    seek_clip_end = seek_clips[0][1]
+
+    def window_mel(seek: int) -> Tuple[mx.array, int]:
+        """The mel of the window at `seek` padded to N_FRAMES, and its size in frames"""
+        segment_size = min(N_FRAMES, content_frames - seek, seek_clip_end - seek)
+        mel_segment = pad_or_trim(mel[seek : seek + segment_size], N_FRAMES, axis=-2)
+        return mel_segment.astype(dtype), segment_size
+
     if verbose:
         system_encoding = sys.getdefaultencoding()
         if system_encoding != "utf-8":
@@ -164,21 +235,29 @@ def transcribe_audio(
     if decode_options.get("language", None) is None:
         if not model.is_multilingual:
             decode_options["language"] = "en"
+        elif language_per_window:
+            # the decoding writes the language detected for each window into
+            # its initial tokens
+            if verbose:
+                print("Detecting the language of every window")
         else:
             if verbose:
                 print(
                     "Detecting language using up to the first 30 seconds. "
                     "Use the `language` decoding option to specify the language"
                 )
-            mel_segment = pad_or_trim(mel, N_FRAMES, axis=-2).astype(dtype)
-            _, probs = model.detect_language(mel_segment)
+            # the first window as it is decoded, so that it is encoded once
+            mel_segment, segment_size = window_mel(0)
+            first_window_features = model.embed_audio(mel_segment[None])[0]
+            first_window = (0, segment_size)
+            _, probs = model.detect_language(first_window_features)
             decode_options["language"] = max(probs, key=probs.get)
             if verbose is not None:
                 print(
                     f"Detected language: {LANGUAGES[decode_options['language']].title()}"
                 )
 
-    language: str = decode_options["language"]
+    language: Optional[str] = decode_options.get("language")
     task: str = decode_options.get("task", "transcribe")
     tokenizer = get_tokenizer(
         model.is_multilingual,
@@ -187,59 +266,136 @@ def transcribe_audio(
         task=task,
     )
 
-    if isinstance(clip_timestamps, str):
-        clip_timestamps = [
-            float(ts) for ts in (clip_timestamps.split(",") if clip_timestamps else [])
-        ]
-    seek_points: List[int] = [round(ts * FRAMES_PER_SECOND) for ts in clip_timestamps]
-    if len(seek_points) == 0:
-        seek_points.append(0)
-    if len(seek_points) % 2 == 1:
-        seek_points.append(content_frames)
-    seek_clips: List[Tuple[int, int]] = list(zip(seek_points[::2], seek_points[1::2]))
-
     punctuation = "\"'“¿([{-\"'.。,，!！?？:：”)]}、"
 
     if word_timestamps and task == "translate":
         warnings.warn("Word-level timestamps on translations may not be reliable.")
     
-    def decode_process(segment_batch, t):
-        kwargs = {**decode_options}
-        options = DecodingOptions(**kwargs, temperature=t)
-        decode_results = model.decode(segment_batch, options)
+    def embed_audio(mel_segments: List[mx.array], mel_timestamps: List[Tuple[int, int]]):
+        """The audio features of the windows, spanning `mel_timestamps`"""
+        if not encode_once:
+            return mel_segments
+        encoded = [None] * len(mel_segments)
+        # the language was detected on the first window
+        if first_window_features is not None and mel_timestamps[0] == first_window:
+            encoded[0] = first_window_features
+        rows = [i for i, features in enumerate(encoded) if features is None]
+        if rows:
+            batch = mx.stack([mel_segments[i] for i in rows])
+            for i, features in zip(rows, model.embed_audio(batch)):
+                encoded[i] = features
+        return encoded
+
+    def get_session() -> DecodingSession:
+        # the session reuses one task per temperature across the windows
+        return DecodingSession.get(
+            model,
+            DecodingOptions(
+                **{k: v for k, v in decode_options.items() if k != "prompt"}
+            ),
+        )
+
+    # the windows stopped early in a repetition loop by `loop_tokens`, and the
+    # decoding steps this saved
+    n_looped = n_loop_steps_saved = 0
+
+    def decode_process(segment_batch, t, prompts, durations, prefill=None):
+        # the session disables beam_size and patience when t > 0 and best_of
+        # when t == 0; the durations limit the tokens of short windows
+        nonlocal n_looped, n_loop_steps_saved
+        session = get_session()
+        draft = draft_model if t == 0 and session.options.beam_size is None else None
+        decode_results = session.decode(
+            segment_batch,
+            prompt=prompts,
+            temperature=t,
+            draft_model=draft,
+            prefill=prefill,
+            durations=durations,
+        )
+        sample_lens = session.task(t)._sample_lens(durations, len(decode_results))
+        for res, sample_len in zip(decode_results, sample_lens):
+            if res.looped:
+                n_looped += 1
+                n_loop_steps_saved += sample_len - len(res.tokens)
         return decode_results
 
-    def decode_with_fallback(segment_batch: mx.array) -> DecodingResult:
-        decode_results = decode_process(segment_batch, 0.0)
-        final_decode = []
-
-        for i, decode_result in enumerate(decode_results):
-            segment = segment_batch[i:i+1, :, :]  
-            needs_fallback = False
-            if (
-                compression_ratio_threshold is not None
-                and decode_result.compression_ratio > compression_ratio_threshold
-            ):
-                needs_fallback = True
+    def needs_fallback(decode_result: DecodingResult) -> bool:
+        needs_fallback = False
+        if (
+            compression_ratio_threshold is not None
+            and decode_result.compression_ratio > compression_ratio_threshold
+        ):
+            needs_fallback = True
+
+        if decode_result.looped:
+            needs_fallback = True
+
+        if (
+            logprob_threshold is not None
+            and decode_result.avg_logprob < logprob_threshold
+        ):
+            needs_fallback = True  
+
+        if (
+            no_speech_threshold is not None
+            and decode_result.no_speech_prob > no_speech_threshold
+        ):
+            needs_fallback = False  
+
+        return needs_fallback
+
+    temperatures = (
+        [temperature] if isinstance(temperature, (int, float)) else temperature
+    )
 
-            if (
-                logprob_threshold is not None
-                and decode_result.avg_logprob < logprob_threshold
-            ):
-                needs_fallback = True  
+    def decode_with_fallback(
+        segment_batch: mx.array,
+        prompts: List[List[int]],
+        durations: List[float],
+        decode_results: Optional[List[DecodingResult]] = None,
+    ) -> List[DecodingResult]:
+        """
+        Decode the batch, each window with its own prompt and duration, at the first
+        temperature, unless its `decode_results` are given, then re-decode the
+        windows that still need a fallback together, as one batch, at each of
+        the next temperatures
+        """
+        # the windows go through the decoder prompt once, and every temperature
+        # starts from there; `prefill_rows` are the windows of `prefill`
+        prefill, prefill_rows = None, []
+        if decode_results is None:
+            prefill = get_session().prefill(segment_batch, prompts)
+            prefill_rows = list(range(len(prompts)))
+            decode_results = decode_process(
+                segment_batch, temperatures[0], prompts, durations, prefill
+            )
+        decode_results = list(decode_results)
+        failed = [i for i, res in enumerate(decode_results) if needs_fallback(res)]
 
-            if (
-                no_speech_threshold is not None
-                and decode_result.no_speech_prob > no_speech_threshold
-            ):
-                needs_fallback = False  
+        for t in temperatures[1:]:
+            if not failed:
+                break
+            failed_batch = segment_batch[mx.array(failed)]
+            failed_prompts = [prompts[i] for i in failed]
+            if prefill is None:
+                prefill = get_session().prefill(failed_batch, failed_prompts)
+                prefill_rows = failed
+            retried = decode_process(
+                failed_batch,
+                t,
+                failed_prompts,
+                [durations[i] for i in failed],
+                prefill.rows([prefill_rows.index(i) for i in failed]),
+            )
+            for i, res in zip(failed, retried):
+                decode_results[i] = res
+            failed = [i for i, res in zip(failed, retried) if needs_fallback(res)]
 
-            if needs_fallback:
-                final_decode.append(decode_process(segment, 1.0)[0])
-            else:
-                final_decode.append(decode_result)
+        return decode_results
 
-        return final_decode
+    def window_duration(start_seek: int, end_seek: int) -> float:
+        return (end_seek - start_seek) * HOP_LENGTH / SAMPLE_RATE
 
     clip_idx = 0
     seek = seek_clips[clip_idx][0]
@@ -317,69 +473,81 @@ def transcribe_audio(
         def next_words_segment(segments: List[dict]) -> Optional[dict]:
             return next((s for s in segments if s["words"]), None)
 
-        timestamp_tokens = tokens >= tokenizer.timestamp_begin
-        single_timestamp_ending = timestamp_tokens[-2:].tolist() == [
-            False,
-            True,
-        ]
-
-        consecutive = np.where(
-            np.logical_and(timestamp_tokens[:-1], timestamp_tokens[1:])
-        )[0]
-        consecutive += 1
-        if len(consecutive) > 0:
-            slices = consecutive.tolist()
-            if single_timestamp_ending:
-                slices.append(len(tokens))
-
-            last_slice = 0
-            for current_slice in slices:
-                sliced_tokens = tokens[last_slice:current_slice]
-                start_timestamp_pos = (
-                    sliced_tokens[0].item() - tokenizer.timestamp_begin
-                )
-                end_timestamp_pos = (
-                    sliced_tokens[-1].item() - tokenizer.timestamp_begin
-                )
-                current_segments.append(
-                    new_segment(
-                        start=time_offset
-                        + start_timestamp_pos * time_precision,
-                        end=time_offset + end_timestamp_pos * time_precision,
-                        tokens=sliced_tokens,
-                        result=res,
-                    )
-                )
-                last_slice = current_slice
-
-            if single_timestamp_ending:
-                seek += segment_size
-            else:
-                last_timestamp_pos = (
-                    tokens[last_slice - 1].item() - tokenizer.timestamp_begin
-                )
-                seek += last_timestamp_pos * input_stride
-        else:
-            duration = segment_duration
-            timestamps = tokens[timestamp_tokens.nonzero()[0]]
-            if (
-                len(timestamps) > 0
-                and timestamps[-1].item() != tokenizer.timestamp_begin
-            ):
-                last_timestamp_pos = (
-                    timestamps[-1].item() - tokenizer.timestamp_begin
-                )
-                duration = last_timestamp_pos * time_precision
-
+        if timestamps == "none":
+            # the whole window is one segment, and the next window follows it
             current_segments.append(
                 new_segment(
                     start=time_offset,
-                    end=time_offset + duration,
+                    end=time_offset + segment_duration,
                     tokens=tokens,
                     result=res,
                 )
             )
             seek += segment_size
+        else:
+            timestamp_tokens = tokens >= tokenizer.timestamp_begin
+            single_timestamp_ending = timestamp_tokens[-2:].tolist() == [
+                False,
+                True,
+            ]
+
+            consecutive = np.where(
+                np.logical_and(timestamp_tokens[:-1], timestamp_tokens[1:])
+            )[0]
+            consecutive += 1
+            if len(consecutive) > 0:
+                slices = consecutive.tolist()
+                if single_timestamp_ending:
+                    slices.append(len(tokens))
+
+                last_slice = 0
+                for current_slice in slices:
+                    sliced_tokens = tokens[last_slice:current_slice]
+                    start_timestamp_pos = (
+                        sliced_tokens[0].item() - tokenizer.timestamp_begin
+                    )
+                    end_timestamp_pos = (
+                        sliced_tokens[-1].item() - tokenizer.timestamp_begin
+                    )
+                    current_segments.append(
+                        new_segment(
+                            start=time_offset
+                            + start_timestamp_pos * time_precision,
+                            end=time_offset + end_timestamp_pos * time_precision,
+                            tokens=sliced_tokens,
+                            result=res,
+                        )
+                    )
+                    last_slice = current_slice
+
+                if single_timestamp_ending:
+                    seek += segment_size
+                else:
+                    last_timestamp_pos = (
+                        tokens[last_slice - 1].item() - tokenizer.timestamp_begin
+                    )
+                    seek += last_timestamp_pos * input_stride
+            else:
+                duration = segment_duration
+                window_timestamps = tokens[timestamp_tokens.nonzero()[0]]
+                if (
+                    len(window_timestamps) > 0
+                    and window_timestamps[-1].item() != tokenizer.timestamp_begin
+                ):
+                    last_timestamp_pos = (
+                        window_timestamps[-1].item() - tokenizer.timestamp_begin
+                    )
+                    duration = last_timestamp_pos * time_precision
+
+                current_segments.append(
+                    new_segment(
+                        start=time_offset,
+                        end=time_offset + duration,
+                        tokens=tokens,
+                        result=res,
+                    )
+                )
+                seek += segment_size
 
         for i, segment in enumerate(current_segments):
             if (
@@ -392,58 +560,138 @@ def transcribe_audio(
         
         return current_segments, seek
 
-    seek_clip_end = seek_clips[0][1]
-    seek = -3000
-    while seek < seek_clip_end:
-        time_offset = float(seek * HOP_LENGTH / SAMPLE_RATE)
+    def add_result(res: DecodingResult, start_seek: int, end_seek: int):
+        nonlocal prompt_reset_since
+
+        tokens = np.array(res.tokens)
+        current_segments, value_seek = format_output(tokens, res) 
+
+        tokens =  [token
+                for segment in current_segments
+                for token in segment["tokens"]
+        ]
+
+        all_segments.append(
+            [start_seek, end_seek, tokenizer.decode(tokens), res.language]
+        )
+           
+        all_tokens.extend(
+            [
+                token
+                for segment in current_segments
+                for token in segment["tokens"]
+            ]
+        )
+
+        if not condition_on_previous_text or res.temperature > 0.5:
+            prompt_reset_since = len(all_tokens)
 
+    seek = -3000
+    if continuous_batching:
+        # every window is decoded on its own, the scheduler admits a new window
+        # into the batch as soon as another one finishes
+        kwargs = {**decode_options}
+        kwargs.pop("best_of", None)
+        kwargs.pop("prompt", None)
+        kwargs.pop("prompt_lookup", None)
+        scheduler = DecodingScheduler(
+            model, DecodingOptions(**kwargs, temperature=temperatures[0]), batch_size
+        )
         mel_segments = []
         mel_timestamps = []
-
-        for _ in range(batch_size):
-            seek +=  N_FRAMES
-            if seek > seek_clip_end:
-                break
-            segment_size = min(
-                N_FRAMES, content_frames - seek, seek_clip_end - seek
+        prompts = []
+
+        def windows():
+            nonlocal seek, segment_size, segment_duration, time_offset
+            while True:
+                seek += N_FRAMES
+                if seek > seek_clip_end:
+                    return
+                time_offset = float(seek * HOP_LENGTH / SAMPLE_RATE)
+                mel_segment, segment_size = window_mel(seek)
+                segment_duration = segment_size * HOP_LENGTH / SAMPLE_RATE
+                mel_segments.append(mel_segment)
+                mel_timestamps.append((seek, seek + segment_size))
+                # the prompt holds the text of the windows added so far
+                prompts.append(all_tokens[prompt_reset_since:])
+                if seek == 0 and first_window_features is not None:
+                    # the scheduler encodes the mel of the other windows
+                    mel_segment = embed_audio([mel_segment], mel_timestamps)[0]
+                yield mel_segment, prompts[-1], segment_duration
+
+        # add the results in the order of the windows; once the next window is
+        # done, the finished windows go through the temperature fallback
+        # together, each with the prompt it was admitted with
+        finished = {}
+        checked = {}
+        n_added = 0
+        for index, res in scheduler.run(windows()):
+            finished[index] = res
+            if n_added not in finished:
+                continue
+            indices = sorted(finished)
+            segment_batch = mx.stack(
+                [
+                    finished[i].audio_features if encode_once else mel_segments[i]
+                    for i in indices
+                ]
+            )
+            results = decode_with_fallback(
+                segment_batch,
+                [prompts[i] for i in indices],
+                [window_duration(*mel_timestamps[i]) for i in indices],
+                [finished.pop(i) for i in indices],
             )
-            mel_segment = mel[seek : seek + segment_size]
+            checked.update(zip(indices, results))
+            while n_added in checked:
+                add_result(checked.pop(n_added), *mel_timestamps[n_added])
+                n_added += 1
 
-            segment_duration = segment_size * HOP_LENGTH / SAMPLE_RATE
-            mel_segment = pad_or_trim(mel_segment, N_FRAMES, axis=-2).astype(dtype)
-            mel_segments.append(mel_segment)
-            mel_timestamps.append((seek, seek + segment_size))
+        if verbose:
+            print(f"Batch occupancy: {scheduler.stats.occupancy:.1%}")
+    else:
+        while seek < seek_clip_end:
+            time_offset = float(seek * HOP_LENGTH / SAMPLE_RATE)
+
+            mel_segments = []
+            mel_timestamps = []
+
+            for _ in range(batch_size):
+                seek +=  N_FRAMES
+                if seek > seek_clip_end:
+                    break
+                mel_segment, segment_size = window_mel(seek)
+                segment_duration = segment_size * HOP_LENGTH / SAMPLE_RATE
+                mel_segments.append(mel_segment)
+                mel_timestamps.append((seek, seek + segment_size))
         
-        if not len(mel_segments):
-            break
-
-        mel_segment_batch = mx.array(mx.stack(mel_segments, axis=0))
-        decode_options["prompt"] = all_tokens[prompt_reset_since:]
-        result: DecodingResult = decode_with_fallback(mel_segment_batch)
-
-        for index, res in enumerate(result):
-            start_seek, end_seek = mel_timestamps[index]
+            if not len(mel_segments):
+                break
 
-            tokens = np.array(res.tokens)
-            current_segments, value_seek = format_output(tokens, res) 
+            # one encoder forward pass per window
+            audio_features = mx.stack(embed_audio(mel_segments, mel_timestamps))
+            # the windows of a batch are decoded at the same time, so they all
+            # follow the text of the previous batches
+            prompts = [all_tokens[prompt_reset_since:]] * len(mel_segments)
+            durations = [window_duration(*t) for t in mel_timestamps]
+            result: DecodingResult = decode_with_fallback(
+                audio_features, prompts, durations
+            )
 
-            tokens =  [token
-                    for segment in current_segments
-                    for token in segment["tokens"]
-            ]
+            for index, res in enumerate(result):
+                start_seek, end_seek = mel_timestamps[index]
+                add_result(res, start_seek, end_seek)
 
-            all_segments.append([start_seek, end_seek,tokenizer.decode(tokens)])
-               
-            all_tokens.extend(
-                [
-                    token
-                    for segment in current_segments
-                    for token in segment["tokens"]
-                ]
-            )
+    if verbose and n_looped:
+        print(
+            f"Stopped {n_looped} repetition loops early, "
+            f"saving {n_loop_steps_saved} decoding steps"
+        )
 
-            if not condition_on_previous_text or res.temperature > 0.5:
-                prompt_reset_since = len(all_tokens)
+    if language is None:
+        # the language of the most windows, the earliest one on a tie
+        languages = [segment[3] for segment in all_segments]
+        language = max(languages, key=languages.count, default=None)
 
     return dict(
         text=tokenizer.decode(all_tokens[len(initial_prompt_tokens) :]),
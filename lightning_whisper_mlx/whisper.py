@@ -52,6 +52,8 @@ class MultiHeadAttention(nn.Module):
         xa=None,
         mask=None,
         kv_cache=None,
+        qk_heads=None,
+        n_qk_keys=None,
     ):
         q = self.query(x)
 
@@ -59,33 +61,78 @@ class MultiHeadAttention(nn.Module):
             k = self.key(x)
             v = self.value(x)
             if kv_cache is not None:
-                k = mx.concatenate([kv_cache[0], k], axis=1)
-                v = mx.concatenate([kv_cache[1], v], axis=1)
+                # write the new positions into the preallocated cache and
+                # attend over its filled prefix
+                k, v = kv_cache.update_and_fetch(k, v)
+            else:
+                kv_cache = (k, v)
         elif kv_cache is None:
             k = self.key(xa)
             v = self.value(xa)
+            kv_cache = (k, v)
         else:
             k, v = kv_cache
 
-        wv, qk = self.qkv_attention(q, k, v, mask)
-        return self.out(wv), (k, v), qk
+        wv = self.qkv_attention(q, k, v, mask)
+        qk = None
+        if qk_heads is not None:
+            qk = self.qk_logits(q, k, qk_heads, n_qk_keys, mask)
+        return self.out(wv), kv_cache, qk
 
     def qkv_attention(self, q, k, v, mask=None):
         n_batch, n_ctx, n_state = q.shape
+        scale = (n_state // self.n_head) ** -0.5
+
+        def split_heads(x):
+            return x.reshape(*x.shape[:2], self.n_head, -1).transpose(0, 2, 1, 3)
+
+        q = split_heads(q)
+        if isinstance(k, tuple):
+            # cached keys and values quantized by `decoding.quantize_kv`, as
+            # (packed, scales, biases); the heads split the same way
+            k, v = tuple(map(split_heads, k)), tuple(map(split_heads, v))
+            out = self.quantized_qkv_attention(q * scale, k, v, mask)
+        else:
+            k, v = split_heads(k), split_heads(v)
+            if mask is not None:
+                # the fused kernel does not promote the mask, which is built in
+                # the model dtype, to the dtype of float16 checkpoint weights
+                mask = mask.astype(q.dtype)
+            out = mx.fast.scaled_dot_product_attention(q, k, v, scale=scale, mask=mask)
+        out = out.transpose(0, 2, 1, 3)
+        return out.reshape(n_batch, n_ctx, n_state)
+
+    def quantized_qkv_attention(self, q, k, v, mask=None):
+        """Attention of the scaled queries `q` over quantized keys and values"""
+        head_dim = q.shape[-1]
+        bits = k[0].shape[-1] * 32 // head_dim
+        group_size = head_dim // k[1].shape[-1]
+
+        qk = mx.quantized_matmul(
+            q, *k, transpose=True, group_size=group_size, bits=bits
+        )
+        if mask is not None:
+            qk = qk + mask
+        w = mx.softmax(qk.astype(mx.float32), axis=-1).astype(q.dtype)
+        return mx.quantized_matmul(
+            w, *v, transpose=False, group_size=group_size, bits=bits
+        )
+
+    def qk_logits(self, q, k, heads, n_keys=None, mask=None):
+        """The attention logits of the given heads over the first `n_keys` keys"""
+        n_state = q.shape[-1]
         scale = (n_state // self.n_head) ** -0.25
-        q = q.reshape(*q.shape[:2], self.n_head, -1).transpose(0, 2, 1, 3) * scale
-        k = k.reshape(*k.shape[:2], self.n_head, -1).transpose(0, 2, 3, 1) * scale
-        v = v.reshape(*v.shape[:2], self.n_head, -1).transpose(0, 2, 1, 3)
+        heads = mx.array(heads)
+        q = q.reshape(*q.shape[:2], self.n_head, -1)[:, :, heads]
+        q = q.transpose(0, 2, 1, 3) * scale
+        k = k[:, :n_keys]
+        k = k.reshape(*k.shape[:2], self.n_head, -1)[:, :, heads]
+        k = k.transpose(0, 2, 3, 1) * scale
 
         qk = q @ k
         if mask is not None:
-            qk = qk + mask[:n_ctx, :n_ctx]
-        qk = qk.astype(mx.float32)
-
-        w = mx.softmax(qk, axis=-1).astype(q.dtype)
-        out = (w @ v).transpose(0, 2, 1, 3)
-        out = out.reshape(n_batch, n_ctx, n_state)
-        return out, qk
+            qk = qk + mask[..., :n_keys]
+        return qk.astype(mx.float32)
 
 
 class ResidualAttentionBlock(nn.Module):
@@ -105,19 +152,26 @@ class ResidualAttentionBlock(nn.Module):
         self.mlp2 = nn.Linear(n_mlp, n_state)
         self.mlp_ln = nn.LayerNorm(n_state)
 
-    def __call__(self, x, xa=None, mask=None, kv_cache=None):
+    def __call__(
+        self, x, xa=None, mask=None, kv_cache=None, cross_qk_heads=None, n_qk_keys=None
+    ):
         kv, cross_kv = kv_cache if kv_cache else (None, None)
         y, kv, _ = self.attn(self.attn_ln(x), mask=mask, kv_cache=kv)
         x += y
         cross_qk = None
         if self.cross_attn:
             y, cross_kv, cross_qk = self.cross_attn(
-                self.cross_attn_ln(x), xa, kv_cache=cross_kv
+                self.cross_attn_ln(x),
+                xa,
+                kv_cache=cross_kv,
+                qk_heads=cross_qk_heads,
+                n_qk_keys=n_qk_keys,
             )
             x += y
         x = x + self.mlp2(nn.gelu(self.mlp1(self.mlp_ln(x))))
         return x, (kv, cross_kv), cross_qk
 
+
 class AudioEncoder(nn.Module):
     def __init__(
         self,
@@ -172,31 +226,123 @@ class TextDecoder(nn.Module):
         self._mask = nn.MultiHeadAttention.create_additive_causal_mask(n_ctx).astype(
             dtype
         )
+        # see _stacked_cross_kv_weights()
+        self._cross_kv_weights = []
 
-    def __call__(self, x, xa, kv_cache=None):
+    def __call__(
+        self,
+        x,
+        xa,
+        kv_cache=None,
+        positions=None,
+        padding_mask=None,
+        logit_positions=None,
+        cross_qk_heads=None,
+        n_qk_keys=None,
+    ):
         """
         x : mx.array, shape = (batch_size, <= n_ctx)
             the text tokens
         xa : mx.array, shape = (batch_size, n_audio_ctx, n_audio_state)
             the encoded audio features to be attended on
+        kv_cache : list of (KVCache, (mx.array, mx.array)), optional
+            per-layer self-attention cache and cross-attention keys/values;
+            the self-attention caches hold the tokens decoded so far
+        positions : mx.array, shape = (batch_size, <= n_ctx), optional
+            the position of each text token within its own row, for rows that
+            do not start at the first cache column
+        padding_mask : mx.array, shape = (batch_size, n_cached + n_tokens), optional
+            boolean mask, False for the cache columns that are not part of a row
+        logit_positions : mx.array, shape = (batch_size, n_logits), optional
+            the positions among the given tokens to compute the logits of, by
+            default all of them; a prompt only needs one or two
+        cross_qk_heads : list of (list of int or None), optional
+            for each layer, the heads to return the cross-attention logits of,
+            e.g. for word alignment; they are not computed otherwise
+        n_qk_keys : int, optional
+            return these logits for the first `n_qk_keys` audio frames only
         """
-        offset = kv_cache[0][0][0].shape[1] if kv_cache else 0
-        x = (
-            self.token_embedding(x)
-            + self.positional_embedding[offset : offset + x.shape[-1]]
+        offset = kv_cache[0][0].offset if kv_cache else 0
+        n_ctx = x.shape[-1]
+        if positions is None:
+            positions = slice(offset, offset + n_ctx)
+        x = self.token_embedding(x) + self.positional_embedding[positions]
+        # a single new token may attend to every cached position
+        mask = (
+            self._mask[offset : offset + n_ctx, : offset + n_ctx] if n_ctx > 1 else None
         )
+        if padding_mask is not None:
+            # a large finite penalty rather than -inf, so that padding positions
+            # which may not attend to any column do not produce NaNs
+            padding_mask = mx.where(padding_mask, 0.0, -1e4)[:, None, None, :]
+            padding_mask = padding_mask.astype(self._mask.dtype)
+            mask = padding_mask if mask is None else mask + padding_mask
 
         if kv_cache is None:
             kv_cache = [None] * len(self.blocks)
+        if cross_qk_heads is None:
+            cross_qk_heads = [None] * len(self.blocks)
         cross_qk = [None] * len(self.blocks)
         for e, block in enumerate(self.blocks):
             x, kv_cache[e], cross_qk[e] = block(
-                x, xa, mask=self._mask, kv_cache=kv_cache[e]
+                x,
+                xa,
+                mask=mask,
+                kv_cache=kv_cache[e],
+                cross_qk_heads=cross_qk_heads[e],
+                n_qk_keys=n_qk_keys,
             )
 
+        if logit_positions is not None:
+            x = mx.take_along_axis(x, logit_positions[..., None], axis=1)
         x = self.ln(x)
         return x @ self.token_embedding.weight.T, kv_cache, cross_qk
 
+    def cross_kv(self, xa):
+        """
+        The cross-attention keys and values of every layer for the audio
+        features `xa`, to be passed in `kv_cache` and reused by every decoding
+        step. The projections of all layers run as one batched matmul.
+        """
+        attns = [block.cross_attn for block in self.blocks]
+        if any(
+            type(layer) is not nn.Linear for a in attns for layer in (a.key, a.value)
+        ):
+            # e.g. quantized layers; project them one by one
+            return [(a.key(xa), a.value(xa)) for a in attns]
+
+        weight, bias = self._stacked_cross_kv_weights()
+        # shape = (2 * n_layer, batch_size, n_audio_ctx, n_state)
+        kv = mx.addmm(bias, xa, weight.swapaxes(-1, -2)[:, None])
+        # split rather than indexed, which would copy them
+        kv = [x.squeeze(0) for x in mx.split(kv, 2 * len(attns))]
+        return list(zip(kv[::2], kv[1::2]))
+
+    def _stacked_cross_kv_weights(self):
+        """
+        The key and value weights of every layer stacked, shape = (2 * n_layer,
+        n_state, n_state), and the matching biases. The layers are then given
+        views into the stacked weights, so that they are not held twice; they
+        are stacked again if the weights were replaced, e.g. by `update()`.
+        """
+        attns = [block.cross_attn for block in self.blocks]
+        layers = [layer for a in attns for layer in (a.key, a.value)]
+        params = [layer.weight for layer in layers] + [a.value.bias for a in attns]
+        if self._cross_kv_weights and all(
+            a is b for a, b in zip(params, self._cross_kv_weights[0])
+        ):
+            return self._cross_kv_weights[1:]
+
+        weight = mx.stack([layer.weight for layer in layers])
+        bias = mx.stack(
+            [b for a in attns for b in (mx.zeros_like(a.value.bias), a.value.bias)]
+        )
+        for i, layer in enumerate(layers):
+            layer.weight = weight[i]
+        params = [layer.weight for layer in layers] + [a.value.bias for a in attns]
+        self._cross_kv_weights = [params, weight, bias[:, None, None]]
+        return self._cross_kv_weights[1:]
+
 
 class Whisper(nn.Module):
     def __init__(self, dims: ModelDimensions, dtype: mx.Dtype = mx.float16):
@@ -248,9 +394,39 @@ class Whisper(nn.Module):
         return self.decoder(tokens, audio_features)[0]
 
     def forward_with_cross_qk(self, mel, tokens):
-        logits, _, cross_qk = self.decoder(tokens, self.encoder(mel))
+        audio_features = mel
+        # skip encoder forward pass if already-encoded audio features were given
+        if mel.shape[-2:] != (self.dims.n_audio_ctx, self.dims.n_audio_state):
+            audio_features = self.encoder(mel)
+        all_heads = list(range(self.dims.n_text_head))
+        logits, _, cross_qk = self.decoder(
+            tokens,
+            audio_features,
+            cross_qk_heads=[all_heads] * self.dims.n_text_layer,
+        )
         return logits, cross_qk
 
+    def forward_with_alignment_qk(self, mel, tokens, n_frames=None):
+        """
+        The logits, and the cross-attention logits of the alignment heads only,
+        over the first `n_frames` audio frames, shape = (batch_size,
+        n_alignment_heads, n_tokens, n_frames), with the heads grouped by layer
+        """
+        audio_features = mel
+        # skip encoder forward pass if already-encoded audio features were given
+        if mel.shape[-2:] != (self.dims.n_audio_ctx, self.dims.n_audio_state):
+            audio_features = self.encoder(mel)
+        cross_qk_heads = [[] for _ in range(self.dims.n_text_layer)]
+        for layer, head in np.array(self.alignment_heads).astype(int).tolist():
+            cross_qk_heads[layer].append(head)
+        logits, _, cross_qk = self.decoder(
+            tokens,
+            audio_features,
+            cross_qk_heads=[heads or None for heads in cross_qk_heads],
+            n_qk_keys=n_frames,
+        )
+        return logits, mx.concatenate([qk for qk in cross_qk if qk is not None], 1)
+
     def __call__(self, mel, tokens):
         return self.decoder(tokens, self.encoder(mel))[0]
 